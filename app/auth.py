@@ -2,6 +2,8 @@ from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from app.config import settings
+import hashlib
+import secrets
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -21,6 +23,29 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     encoded_jwt = jwt.encode(to_encode, settings.JWT_SECRET, algorithm="HS256")
     return encoded_jwt
 
+def decode_access_token(token: str) -> dict:
+    """Validate an access token and return its claims (raises JWTError)"""
+    return jwt.decode(token, settings.JWT_SECRET, algorithms=["HS256"])
+
+def bearer_claims(request) -> dict:
+    """Claims of a valid bearer access token on the request, else an empty dict"""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return {}
+    try:
+        return decode_access_token(token)
+    except JWTError:
+        return {}
+
+def create_refresh_token() -> str:
+    """Generate an opaque refresh token"""
+    return secrets.token_urlsafe(32)
+
+def hash_refresh_token(token: str) -> str:
+    # Refresh tokens are 256 random bits, so a fast unsalted hash is enough to
+    # keep them unusable from a DB dump; bcrypt would only add per-request cost
+    return hashlib.sha256(token.encode()).hexdigest()
+
 def get_current_user():
     # Placeholder - implement JWT token validation
     return {"id": 1, "email": "demo@localhost", "is_admin": True}
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""Response caching, ETags and compression for catalog endpoints.
+
+Routes registered with ``cache_route`` have their serialized 200 responses
+kept per variant (the tuple returned by the route's variant function) for
+CATALOG_CACHE_TTL seconds. Cached bodies get a strong ETag, so clients and
+CDNs can revalidate with If-None-Match and receive a 304, and bodies above
+CATALOG_COMPRESS_MIN_BYTES are served gzip- or brotli-encoded when the
+client accepts it. Compressed forms are computed once per cache entry.
+"""
+import gzip
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from fastapi import Request, Response
+
+from app.auth import bearer_claims
+from app.config import settings
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+class CachedRoute:
+    def __init__(self, variant: Callable[[Request], Optional[tuple]], cache_control: Callable[[Request], str],
+                 requires_auth: bool):
+        self.variant = variant
+        self.cache_control = cache_control
+        self.requires_auth = requires_auth
+
+class CachedBody:
+    def __init__(self, body: bytes, media_type: str):
+        self.body = body
+        self.media_type = media_type
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.expires_at = time.monotonic() + settings.CATALOG_CACHE_TTL
+        self._encoded: Dict[str, bytes] = {}
+
+    def encoded(self, encoding: str) -> bytes:
+        if encoding == "identity":
+            return self.body
+        if encoding not in self._encoded:
+            if encoding == "br":
+                self._encoded[encoding] = brotli.compress(self.body)
+            else:
+                self._encoded[encoding] = gzip.compress(self.body, compresslevel=6)
+        return self._encoded[encoding]
+
+    def tag(self, encoding: str) -> str:
+        # Each representation needs its own strong validator
+        return f'"{self.etag}"' if encoding == "identity" else f'"{self.etag}-{encoding}"'
+
+routes: Dict[str, CachedRoute] = {}
+_cache: "OrderedDict[tuple, CachedBody]" = OrderedDict()
+
+def cache_route(path: str, variant, cache_control, requires_auth: bool = False):
+    """Serve GET path through the catalog cache.
+
+    variant(request) returns the hashable cache key for the request, or None
+    when the response must not be cached; cache_control(request) returns the
+    Cache-Control header value.
+    """
+    routes[path] = CachedRoute(variant, cache_control, requires_auth)
+
+def negotiate_encoding(accept_encoding: str, size: int) -> str:
+    if size < settings.CATALOG_COMPRESS_MIN_BYTES:
+        return "identity"
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return "identity"
+
+def _matches(if_none_match: str, entry: CachedBody) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return any(entry.tag(encoding) in candidates for encoding in ("identity", "gzip", "br"))
+
+def _get(key) -> Optional[CachedBody]:
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    if entry.expires_at <= time.monotonic():
+        del _cache[key]
+        return None
+    _cache.move_to_end(key)
+    return entry
+
+def _put(key, entry: CachedBody):
+    _cache[key] = entry
+    _cache.move_to_end(key)
+    while len(_cache) > settings.CATALOG_CACHE_ENTRIES:
+        _cache.popitem(last=False)
+
+async def catalog_cache(request: Request, call_next):
+    """HTTP middleware: serve registered catalog routes from the cache"""
+    route = routes.get(request.url.path)
+    if route is None or request.method != "GET":
+        return await call_next(request)
+    # Never hand out a cached body the endpoint itself would have refused
+    if route.requires_auth and not bearer_claims(request):
+        return await call_next(request)
+
+    variant = route.variant(request)
+    if variant is None:
+        return await call_next(request)
+
+    key = (request.url.path, variant)
+    entry = _get(key)
+    if entry is None:
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        entry = CachedBody(body, response.headers.get("content-type", "application/json"))
+        _put(key, entry)
+
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), len(entry.body))
+    headers = {
+        "ETag": entry.tag(encoding),
+        "Cache-Control": route.cache_control(request),
+        "Vary": "Accept-Encoding, Authorization" if route.requires_auth else "Accept-Encoding"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _matches(if_none_match, entry):
+        return Response(status_code=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=entry.encoded(encoding), media_type=entry.media_type, headers=headers)
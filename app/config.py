@@ -3,11 +3,45 @@ from pydantic import BaseSettings
 class Settings(BaseSettings):
     DATABASE_URL: str
     JWT_SECRET: str
-    ACCESS_TOKEN_EXPIRE_MINUTES: int = 1440
+    ACCESS_TOKEN_EXPIRE_MINUTES: int = 15
+    REFRESH_TOKEN_EXPIRE_DAYS: int = 30
     HETZNER_API_TOKEN: str = ""
     WG_BASE_DIR: str = '/etc/wireguard'
     WG_LISTEN_PORT: int = 51820
     ADMIN_EMAIL: str = 'admin@localhost'
+    SHARD_DATABASE_URLS: str = ''  # comma-separated; empty means the primary is the only shard
+    SHARD_VNODES: int = 128
+    SHARD_PIN_REFRESH_SECONDS: float = 10.0
+    EXPORT_BATCH_SIZE: int = 1000
+    GEOIP_DB_PATH: str = ''
+    GEOIP_RELOAD_INTERVAL: float = 30.0
+    TRUST_PROXY_HEADERS: bool = False
+    TRUSTED_PROXY_COUNT: int = 1
+    RECOMMEND_POOL_REFRESH_SECONDS: float = 30.0
+    IDEMPOTENCY_TTL_SECONDS: int = 86400
+    IDEMPOTENCY_LEASE_SECONDS: int = 60
+    IDEMPOTENCY_CACHE_ENTRIES: int = 10000
+    IDEMPOTENCY_CACHE_BYTES: int = 16 * 1024 * 1024
+    PROFILE_SAMPLE_RATE: float = 0.0
+    PROFILE_BUFFER_SIZE: int = 200
+    PROFILE_N_PLUS_ONE_THRESHOLD: int = 3
+    PROFILE_CPU_INTERVAL_MS: float = 5.0
+    CATALOG_CACHE_TTL: int = 60
+    CATALOG_CACHE_ENTRIES: int = 1024
+    CATALOG_COMPRESS_MIN_BYTES: int = 1024
+    FREQ_CAP_IMPRESSIONS: int = 3
+    FREQ_CAP_WINDOW_SECONDS: float = 86400.0
+    FREQ_CAP_BUCKETS: int = 24
+    FREQ_CAP_MAX_USERS: int = 100000
+    FREQ_CAP_SYNC_SECONDS: float = 5.0
+    FRAUD_DEDUP_WINDOW_SECONDS: float = 300.0
+    FRAUD_DEDUP_CAPACITY: int = 1000000
+    FRAUD_DEDUP_FP_RATE: float = 0.001
+    FRAUD_VELOCITY_WINDOW_SECONDS: float = 60.0
+    FRAUD_VELOCITY_MAX_EVENTS: int = 120
+    LOG_LEVEL: str = 'INFO'
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_SAMPLING: str = ''  # e.g. 'sqlalchemy.engine=0.01,uvicorn.access=0.1'
 
     class Config:
         env_file = '.env'
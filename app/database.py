@@ -1,11 +1,21 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
+from app.sharding import ShardRouter, parse_shard_urls
 
-engine = create_async_engine(settings.DATABASE_URL, echo=True)
+# SQL logging goes through app.log; enable it with LOG_SAMPLING=sqlalchemy.engine=<rate>
+engine = create_async_engine(settings.DATABASE_URL)
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+shards = ShardRouter(
+    parse_shard_urls(settings.SHARD_DATABASE_URLS, settings.DATABASE_URL),
+    primary=engine,
+    primary_url=settings.DATABASE_URL,
+    vnodes=settings.SHARD_VNODES
+)
+
 async def get_db():
+    """Session on the primary database (global tables)"""
     async with AsyncSessionLocal() as session:
         try:
             yield session
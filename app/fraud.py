@@ -0,0 +1,169 @@
+"""Ingest-time filtering of duplicate and high-velocity ad events.
+
+Every event is attributed to a source: the authenticated user, or the client
+address for anonymous events. Two checks run before an event is stored:
+
+* velocity: a count-min sketch counts events per source in fixed windows of
+  FRAUD_VELOCITY_WINDOW_SECONDS; sources above FRAUD_VELOCITY_MAX_EVENTS are
+  rejected for the rest of the window.
+* duplicates: a (source, ad, event type) tuple already seen within
+  FRAUD_DEDUP_WINDOW_SECONDS is rejected; events without an ad id in their
+  metadata are never treated as duplicates. Seen tuples are kept in two
+  rotating Bloom filters sized from FRAUD_DEDUP_CAPACITY and
+  FRAUD_DEDUP_FP_RATE, so memory is fixed up front; a false positive drops a
+  genuine event, never stores a duplicate.
+
+Rejected events are counted per reason, not stored. Filters are per worker.
+"""
+import hashlib
+import math
+import time
+from array import array
+from collections import Counter
+from typing import Optional
+
+from app.config import settings
+
+SKETCH_WIDTH = 1 << 16
+SKETCH_DEPTH = 4
+
+def _hashes(key: str):
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    # Kirsch-Mitzenmacher: two base hashes stand in for k independent ones
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+class BloomFilter:
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        h1, h2 = _hashes(key)
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+class RotatingBloomFilter:
+    """Set membership over the last window, in two Bloom filter generations.
+
+    The current generation is retired every half window, or early once it
+    holds capacity keys so the false-positive rate never exceeds fp_rate;
+    keys therefore stay visible for between half a window and a full one.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float, window_seconds: float):
+        self.capacity = capacity
+        # Lookups consult both generations, so each gets half the error budget
+        self.fp_rate = fp_rate / 2
+        self.rotate_seconds = window_seconds / 2
+        self.current = BloomFilter(capacity, self.fp_rate)
+        self.previous = BloomFilter(capacity, self.fp_rate)
+        self.rotated_at = time.monotonic()
+        self.rotations = 0
+
+    def _maybe_rotate(self, now: float):
+        if now - self.rotated_at >= self.rotate_seconds or self.current.count >= self.capacity:
+            if now - self.rotated_at >= 2 * self.rotate_seconds:
+                self.previous = BloomFilter(self.capacity, self.fp_rate)
+            else:
+                self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.fp_rate)
+            self.rotated_at = now
+            self.rotations += 1
+
+    def check_and_add(self, key: str) -> bool:
+        """True if key was (probably) seen within the window; records it either way"""
+        self._maybe_rotate(time.monotonic())
+        if key in self.current:
+            return True
+        seen = key in self.previous
+        self.current.add(key)
+        return seen
+
+    def stats(self) -> dict:
+        return {
+            "bits": self.current.size,
+            "hashes": self.current.hash_count,
+            "bytes": len(self.current.bits) + len(self.previous.bits),
+            "current_keys": self.current.count,
+            "rotations": self.rotations
+        }
+
+class CountMinSketch:
+    def __init__(self, width: int, depth: int):
+        self.width = width
+        self.depth = depth
+        self.table = array('I', bytes(4 * width * depth))
+
+    def add(self, key: str) -> int:
+        """Count key once and return its estimated count (never an underestimate)"""
+        h1, h2 = _hashes(key)
+        estimate = None
+        for row in range(self.depth):
+            idx = row * self.width + (h1 + row * h2) % self.width
+            self.table[idx] += 1
+            estimate = self.table[idx] if estimate is None else min(estimate, self.table[idx])
+        return estimate
+
+    def clear(self):
+        self.table = array('I', bytes(4 * self.width * self.depth))
+
+class VelocityLimiter:
+    """Per-source event counts in fixed windows"""
+
+    def __init__(self, max_events: int, window_seconds: float):
+        self.max_events = max_events
+        self.window_seconds = window_seconds
+        self.sketch = CountMinSketch(SKETCH_WIDTH, SKETCH_DEPTH)
+        self.window = None
+
+    def exceeded(self, source: str) -> bool:
+        window = int(time.time() // self.window_seconds)
+        if window != self.window:
+            self.sketch.clear()
+            self.window = window
+        return self.sketch.add(source) > self.max_events
+
+class EventFilter:
+    def __init__(self):
+        self.velocity = VelocityLimiter(settings.FRAUD_VELOCITY_MAX_EVENTS, settings.FRAUD_VELOCITY_WINDOW_SECONDS)
+        self.seen = RotatingBloomFilter(
+            settings.FRAUD_DEDUP_CAPACITY, settings.FRAUD_DEDUP_FP_RATE, settings.FRAUD_DEDUP_WINDOW_SECONDS
+        )
+        self.accepted = 0
+        self.rejected = Counter()
+
+    def check(self, source: str, ad_id: Optional[int], event_type: str) -> Optional[str]:
+        """Reason to drop the event ('velocity' or 'duplicate'), or None to store it"""
+        if self.velocity.exceeded(source):
+            reason = "velocity"
+        # Without an ad id, events for different ads would share one key
+        elif ad_id is not None and self.seen.check_and_add(f"{source}|{ad_id}|{event_type}"):
+            reason = "duplicate"
+        else:
+            self.accepted += 1
+            return None
+        self.rejected[reason] += 1
+        return reason
+
+    def stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "rejected": dict(self.rejected),
+            "dedup_filter": self.seen.stats(),
+            "velocity_sketch_bytes": len(self.velocity.sketch.table) * self.velocity.sketch.table.itemsize
+        }
+
+event_filter = EventFilter()
+
+def event_source(user_id: Optional[int], ip: Optional[str]) -> str:
+    return f"user:{user_id}" if user_id is not None else f"ip:{ip or 'unknown'}"
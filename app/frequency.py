@@ -0,0 +1,211 @@
+"""Per-user ad frequency capping.
+
+Impressions are counted per (user, ad) in a ring of FREQ_CAP_BUCKETS time
+buckets spanning FREQ_CAP_WINDOW_SECONDS, so the count always covers the
+last window and old buckets are reused instead of reallocated. Users are
+kept in LRU order and dropped after a full window without impressions, or
+when more than FREQ_CAP_MAX_USERS are tracked.
+
+Each worker counts the impressions it ingests immediately and polls
+``ad_events`` on every shard for the ones ingested by other workers. The
+first poll of a shard starts at the oldest event inside the window (found
+through the ``created_at`` index). Rows much older than the previous poll
+of their shard are copies made by a shard move, already counted from the
+shard they came from, and are skipped.
+"""
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, FrozenSet, Optional
+
+from sqlalchemy import func
+from sqlalchemy.future import select
+
+from app.config import settings
+from app.models import AdEvent
+
+IMPRESSION_EVENTS = ('impression', 'view')
+SYNC_BATCH_SIZE = 5000
+# How long after its created_at an event may still commit and first become visible
+LATE_COMMIT_SECONDS = 60.0
+_COUNTER_MAX = 0xFFFF
+
+class _AdCounter:
+    __slots__ = ('epoch', 'buckets')
+
+    def __init__(self, size: int, epoch: int):
+        self.epoch = epoch
+        self.buckets = array('H', bytes(2 * size))
+
+class _UserCounters:
+    __slots__ = ('ads', 'last_seen')
+
+    def __init__(self):
+        self.ads: Dict[int, _AdCounter] = {}
+        self.last_seen = 0.0
+
+class FrequencyCapper:
+    def __init__(self, cap: int, window_seconds: float, buckets: int, max_users: int):
+        self.cap = cap
+        self.window_seconds = window_seconds
+        self.size = buckets
+        self.bucket_seconds = window_seconds / buckets
+        self.max_users = max_users
+        self._users: "OrderedDict[int, _UserCounters]" = OrderedDict()
+
+    def _advance(self, counter: _AdCounter, epoch: int):
+        """Zero the buckets that fell out of the window since the counter was last used"""
+        stale = epoch - counter.epoch
+        if stale <= 0:
+            return
+        if stale >= self.size:
+            counter.buckets = array('H', bytes(2 * self.size))
+        else:
+            for e in range(counter.epoch + 1, epoch + 1):
+                counter.buckets[e % self.size] = 0
+        counter.epoch = epoch
+
+    def record(self, user_id: int, ad_id: int, at: Optional[float] = None):
+        """Count one impression of ad_id for user_id at time at (default now)"""
+        now = time.time()
+        at = now if at is None else at
+        if at <= now - self.window_seconds:
+            return
+        epoch = int(at // self.bucket_seconds)
+
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _UserCounters()
+        self._users.move_to_end(user_id)
+        user.last_seen = now
+
+        counter = user.ads.get(ad_id)
+        if counter is None:
+            counter = user.ads[ad_id] = _AdCounter(self.size, epoch)
+        self._advance(counter, max(epoch, counter.epoch))
+        if epoch > counter.epoch - self.size:
+            slot = epoch % self.size
+            if counter.buckets[slot] < _COUNTER_MAX:
+                counter.buckets[slot] += 1
+
+        self.evict(now)
+
+    def count(self, user_id: int, ad_id: int) -> int:
+        user = self._users.get(user_id)
+        counter = user.ads.get(ad_id) if user else None
+        if counter is None:
+            return 0
+        self._advance(counter, int(time.time() // self.bucket_seconds))
+        return sum(counter.buckets)
+
+    def capped_ads(self, user_id: int) -> FrozenSet[int]:
+        """Ads the user has reached the cap for within the window"""
+        user = self._users.get(user_id)
+        if user is None:
+            return frozenset()
+        return frozenset(ad_id for ad_id in user.ads if self.count(user_id, ad_id) >= self.cap)
+
+    def evict(self, now: Optional[float] = None):
+        """Drop users idle for a whole window, oldest first, and enforce max_users"""
+        now = time.time() if now is None else now
+        idle_before = now - self.window_seconds
+        while self._users:
+            user_id, user = next(iter(self._users.items()))
+            if user.last_seen >= idle_before and len(self._users) <= self.max_users:
+                break
+            del self._users[user_id]
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "counters": sum(len(user.ads) for user in self._users.values()),
+            "cap": self.cap,
+            "window_seconds": self.window_seconds
+        }
+
+capper = FrequencyCapper(
+    settings.FREQ_CAP_IMPRESSIONS,
+    settings.FREQ_CAP_WINDOW_SECONDS,
+    settings.FREQ_CAP_BUCKETS,
+    settings.FREQ_CAP_MAX_USERS
+)
+
+def event_ad_id(metadata) -> Optional[int]:
+    """Ad id carried in an ad event's metadata (``adId`` or ``ad_id``), if any"""
+    if not isinstance(metadata, dict):
+        return None
+    try:
+        return int(metadata.get('adId', metadata.get('ad_id')))
+    except (TypeError, ValueError):
+        return None
+
+class ImpressionSync:
+    """Feed impressions written by other workers into the local capper"""
+
+    def __init__(self, capper: FrequencyCapper):
+        self.capper = capper
+        self.watermarks: Dict[str, int] = {}
+        self.own_events: Dict[str, set] = {}
+        self.polled_at: Dict[str, float] = {}
+
+    def record_local(self, shard: str, event_id: int, user_id: int, ad_id: int):
+        """Count an impression ingested by this worker and keep the poll from counting it again"""
+        if shard in self.watermarks and event_id <= self.watermarks[shard]:
+            return  # a poll already picked it up
+        self.own_events.setdefault(shard, set()).add(event_id)
+        self.capper.record(user_id, ad_id)
+
+    async def _seed_watermark(self, shard: str, session, cutoff: datetime):
+        """Start just below the oldest event inside the window, or at the newest event"""
+        first_id = await session.scalar(select(func.min(AdEvent.id)).where(AdEvent.created_at >= cutoff))
+        if first_id is not None:
+            self.watermarks[shard] = first_id - 1
+        else:
+            self.watermarks[shard] = await session.scalar(select(func.max(AdEvent.id))) or 0
+
+    async def poll(self, shard: str, session):
+        started = time.time()
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.capper.window_seconds)
+        if shard not in self.watermarks:
+            await self._seed_watermark(shard, session, cutoff)
+        previous = self.polled_at.get(shard)
+        copied_before = previous - LATE_COMMIT_SECONDS if previous is not None else None
+
+        while True:
+            result = await session.execute(
+                select(AdEvent.id, AdEvent.user_id, AdEvent.event_metadata, AdEvent.created_at)
+                .filter(
+                    AdEvent.id > self.watermarks[shard],
+                    AdEvent.event_type.in_(IMPRESSION_EVENTS),
+                    AdEvent.created_at >= cutoff
+                )
+                .order_by(AdEvent.id)
+                .limit(SYNC_BATCH_SIZE)
+            )
+            rows = result.all()
+            if not rows:
+                break
+
+            own = self.own_events.get(shard, set())
+            for event_id, user_id, metadata, created_at in rows:
+                ad_id = event_ad_id(metadata)
+                if event_id in own or user_id is None or ad_id is None:
+                    continue
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                at = created_at.timestamp()
+                if copied_before is not None and at < copied_before:
+                    continue  # moved here from another shard, already counted there
+                self.capper.record(user_id, ad_id, at)
+
+            watermark = rows[-1][0]
+            self.watermarks[shard] = watermark
+            # Own ids at or below the watermark can no longer show up in a poll
+            self.own_events[shard] = {event_id for event_id in own if event_id > watermark}
+            if len(rows) < SYNC_BATCH_SIZE:
+                break
+
+        self.polled_at[shard] = started
+
+impression_sync = ImpressionSync(capper)
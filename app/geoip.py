@@ -0,0 +1,168 @@
+"""Local IPv4-to-country lookups backed by a memory-mapped range table.
+
+The dataset is compiled from a CSV of ``start,end,country`` rows into a flat
+binary file: a 16-byte header followed by three parallel arrays (range starts,
+range ends and two-letter country codes) sorted by start address. Every worker
+maps the same file read-only, so the table lives once in the page cache and a
+lookup is a single binary search over the starts array.
+
+Build or refresh the table with::
+
+    python -m app.geoip ranges.csv /var/lib/modernvpn/geoip.bin
+
+The file is swapped in with an atomic rename and running workers pick it up
+on their next lookup after GEOIP_RELOAD_INTERVAL seconds.
+"""
+import argparse
+import csv
+import ipaddress
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from typing import Optional
+
+from app.config import settings
+from app.utils import client_ip
+
+MAGIC = b"MVGEO1"
+HEADER = struct.Struct("=6sxxII")  # magic, padding, record count, reserved
+
+def _parse_ipv4(value: str) -> Optional[int]:
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    if ":" in value:
+        # IPv6 ranges are not supported by the table format
+        return None
+    return int(ipaddress.IPv4Address(value))
+
+def build_database(csv_path: str, out_path: str) -> int:
+    """Compile a start,end,country CSV into the binary lookup table"""
+    ranges = []
+    with open(csv_path, newline="") as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or not row[0].strip() or row[0].startswith("#"):
+                continue
+            try:
+                start, end = _parse_ipv4(row[0]), _parse_ipv4(row[1])
+            except ValueError:
+                continue  # header line or malformed address
+            country = row[2].strip().upper()
+            if start is None or end is None or len(country) != 2 or country in ("-", "ZZ"):
+                continue
+            ranges.append((start, end, country))
+
+    ranges.sort()
+    starts = array("I", (r[0] for r in ranges))
+    ends = array("I", (r[1] for r in ranges))
+    countries = "".join(r[2] for r in ranges).encode("ascii")
+
+    tmp_path = f"{out_path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(ranges), 0))
+        starts.tofile(f)
+        ends.tofile(f)
+        f.write(countries)
+    # Atomic swap: mapped readers keep the old inode until they reload
+    os.replace(tmp_path, out_path)
+    return len(ranges)
+
+class _MappedTable:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path} is not a GeoIP table")
+
+        view = memoryview(self._mm)
+        offset = HEADER.size
+        width = count * 4
+        self.starts = view[offset:offset + width].cast("I")
+        self.ends = view[offset + width:offset + 2 * width].cast("I")
+        self.countries = view[offset + 2 * width:offset + 2 * width + 2 * count]
+        self._view = view
+
+    def lookup(self, ip: int) -> Optional[str]:
+        idx = bisect_right(self.starts, ip) - 1
+        if idx < 0 or ip > self.ends[idx]:
+            return None
+        return bytes(self.countries[2 * idx:2 * idx + 2]).decode("ascii")
+
+    def close(self):
+        # Views must be released before the mapping can be closed
+        for view in (self.starts, self.ends, self.countries, self._view):
+            view.release()
+        self._mm.close()
+
+class GeoIPResolver:
+    """Resolve IPv4 addresses to ISO country codes, reloading on file change"""
+
+    def __init__(self, path: str, reload_interval: float = 30.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._table: Optional[_MappedTable] = None
+        self._next_check = 0.0
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return  # keep serving the table we have, if any
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._table and self._table.signature == signature:
+            return
+
+        try:
+            table = _MappedTable(self.path)
+        except (OSError, ValueError):
+            return
+        old, self._table = self._table, table
+        if old:
+            old.close()
+
+    def lookup(self, ip: str) -> Optional[str]:
+        if not self.path or not ip:
+            return None
+        self._maybe_reload()
+        if self._table is None:
+            return None
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version != 4:
+            return None
+        return self._table.lookup(int(address))
+
+resolver = GeoIPResolver(settings.GEOIP_DB_PATH, settings.GEOIP_RELOAD_INTERVAL)
+
+def resolve_request_country(request) -> Optional[str]:
+    """Country of the client that sent the request, if the dataset knows it"""
+    return resolver.lookup(client_ip(request))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile a GeoIP range CSV into a lookup table")
+    parser.add_argument("csv_path", help="CSV with start,end,country rows (dotted or integer IPv4)")
+    parser.add_argument("out_path", help="Destination table file, e.g. GEOIP_DB_PATH")
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    count = build_database(args.csv_path, args.out_path)
+    print(f"wrote {count} ranges to {args.out_path} in {time.monotonic() - started:.2f}s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
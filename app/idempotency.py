@@ -0,0 +1,225 @@
+import hashlib
+import json
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional, Tuple
+
+from fastapi import HTTPException, Response, status
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.config import settings
+from app.models import IdempotencyKey
+
+# Approximate per-entry bookkeeping: OrderedDict node plus the entry tuple
+ENTRY_OVERHEAD = sys.getsizeof((0.0, "", 0, b"")) + 100
+
+class IdempotencyCache:
+    """Bounded LRU of completed responses, limited by entry count and bytes"""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, fingerprint, status_code, body)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(key: str, fingerprint: str, body: bytes) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(fingerprint) + sys.getsizeof(body) + ENTRY_OVERHEAD
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] <= time.time():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, expires_at: float, fingerprint: str, status_code: int, body: bytes):
+        if key in self._entries:
+            self._remove(key)
+        size = self._entry_size(key, fingerprint, body)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, fingerprint, status_code, body)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, fingerprint, _, body = self._entries.pop(key)
+        self.bytes -= self._entry_size(key, fingerprint, body)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+cache = IdempotencyCache(settings.IDEMPOTENCY_CACHE_ENTRIES, settings.IDEMPOTENCY_CACHE_BYTES)
+
+def request_fingerprint(payload) -> str:
+    """Hash of the request body, used to reject a key reused for a different request"""
+    return hashlib.sha256(
+        json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+def replay_response(status_code: int, body: bytes) -> Response:
+    return Response(
+        content=body,
+        status_code=status_code,
+        media_type="application/json",
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+def _check_fingerprint(stored: str, fingerprint: str):
+    if stored != fingerprint:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used with a different request"
+        )
+
+def _aware(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+def _in_progress() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="A request with this Idempotency-Key is still in progress"
+    )
+
+async def _claim(db: AsyncSession, key: str, fingerprint: str) -> Tuple[Optional[Response], Optional[datetime]]:
+    """Return the stored response for key, or claim key for a new request.
+
+    A claim is identified by its claimed_at; one older than
+    IDEMPOTENCY_LEASE_SECONDS belongs to an attempt that died and is taken over.
+    """
+    entry = cache.get(key)
+    if entry:
+        _check_fingerprint(entry[1], fingerprint)
+        return replay_response(entry[2], entry[3]), None
+
+    now = datetime.now(timezone.utc)
+    result = await db.execute(select(IdempotencyKey).filter(IdempotencyKey.key == key))
+    record = result.scalars().first()
+
+    if record:
+        expires_at = _aware(record.expires_at)
+        if expires_at <= now:
+            await db.delete(record)
+            await db.commit()
+            record = None
+
+    if record:
+        _check_fingerprint(record.fingerprint, fingerprint)
+        if record.status_code is None:
+            stale_before = now - timedelta(seconds=settings.IDEMPOTENCY_LEASE_SECONDS)
+            if record.claimed_at is not None and _aware(record.claimed_at) > stale_before:
+                raise _in_progress()
+            # Only one retry wins the takeover: the update matches the old claim exactly
+            if record.claimed_at is None:
+                old_claim = IdempotencyKey.claimed_at.is_(None)
+            else:
+                old_claim = IdempotencyKey.claimed_at == record.claimed_at
+            result = await db.execute(
+                update(IdempotencyKey)
+                .where(IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None), old_claim)
+                .values(claimed_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+            if result.rowcount != 1:
+                raise _in_progress()
+            return None, now
+        body = record.response_body.encode()
+        cache.put(key, expires_at.timestamp(), record.fingerprint, record.status_code, body)
+        return replay_response(record.status_code, body), None
+
+    # The unique index on key lets exactly one concurrent request claim it
+    db.add(IdempotencyKey(
+        key=key,
+        fingerprint=fingerprint,
+        claimed_at=now,
+        expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS)
+    ))
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise _in_progress()
+    return None, now
+
+async def run_idempotent(
+    db: AsyncSession,
+    scope: str,
+    idempotency_key: Optional[str],
+    payload,
+    handler: Callable[[], Awaitable[dict]]
+):
+    """Run handler at most once per (scope, Idempotency-Key).
+
+    Retries with the same key get the first successful response back without
+    calling the handler again. Failed attempts release the key so the client
+    can retry them.
+    """
+    if not idempotency_key:
+        return await handler()
+
+    key = f"{scope}:{idempotency_key}"
+    fingerprint = request_fingerprint(payload)
+    replay, claimed_at = await _claim(db, key, fingerprint)
+    if replay is not None:
+        return replay
+    # Later writes only touch the row while it still carries this attempt's claim
+    ours = (IdempotencyKey.key == key, IdempotencyKey.claimed_at == claimed_at, IdempotencyKey.status_code.is_(None))
+
+    try:
+        response = await handler()
+    except Exception:
+        await db.rollback()
+        await db.execute(delete(IdempotencyKey).where(*ours))
+        await db.commit()
+        raise
+
+    body = json.dumps(jsonable_encoder(response), separators=(",", ":"))
+    result = await db.execute(
+        update(IdempotencyKey)
+        .where(*ours)
+        .values(status_code=status.HTTP_200_OK, response_body=body)
+        .returning(IdempotencyKey.expires_at)
+    )
+    expires_at = result.scalar()
+    await db.commit()
+    if expires_at is not None:
+        expires_at = _aware(expires_at)
+        cache.put(key, expires_at.timestamp(), fingerprint, status.HTTP_200_OK, body.encode())
+
+    return response
+
+async def purge_expired_keys(db: AsyncSession) -> int:
+    """Delete expired idempotency records"""
+    result = await db.execute(
+        delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.now(timezone.utc))
+    )
+    await db.commit()
+    return result.rowcount
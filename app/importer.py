@@ -0,0 +1,250 @@
+"""Bulk user import from CSV or NDJSON.
+
+    python -m app.importer customers.csv --chunk-size 5000
+    python -m app.importer customers.ndjson --start-line 120000
+
+Each record needs an ``email`` and either a plaintext ``password`` (hashed
+with bcrypt across a process pool) or an existing bcrypt ``hashed_password``.
+``is_admin`` is optional. Records are processed in chunks. New emails are
+COPY'd into a temporary table and registered in ``user_directory`` with
+ON CONFLICT DO NOTHING on the unique email index, which allocates their ids;
+the directory is committed first. The chunk's users that are missing from
+their shard, new ones as well as directory entries left behind by an
+interrupted run, are then COPY'd to the shard through a staging table with
+ON CONFLICT DO NOTHING, so re-running a chunk never duplicates a user.
+Progress lines report the next record offset, so an interrupted run can be
+resumed with --start-line.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import psycopg2
+
+from app.auth import get_password_hash
+from app.config import settings
+from app.sharding import HashRing, parse_shard_urls
+
+BCRYPT_HASH = re.compile(r"^\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}$")
+TRUE_VALUES = {"1", "true", "t", "yes", "y"}
+
+def read_records(path: str, fmt: str, start: int):
+    """Yield records from the file, skipping the first start records"""
+    with open(path, newline="") as f:
+        if fmt == "csv":
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        yield from islice(records, start, None)
+
+def sync_dsn(url: str) -> str:
+    """Turn the app's SQLAlchemy async URL into a libpq connection string"""
+    return re.sub(r"^postgresql\+\w+://", "postgresql://", url)
+
+def prepare_chunk(records):
+    """Normalize a chunk, keeping the first occurrence of each email.
+
+    Returns the usable rows and the number of invalid or duplicate records.
+    """
+    seen_in_chunk = set()
+    rows = []
+    invalid = 0
+    for record in records:
+        email = (record.get("email") or "").strip()
+        password = record.get("password")
+        hashed = (record.get("hashed_password") or "").strip()
+        if not email or email in seen_in_chunk or not (password or hashed):
+            invalid += 1
+            continue
+        if hashed and not BCRYPT_HASH.match(hashed):
+            invalid += 1
+            continue
+        seen_in_chunk.add(email)
+        rows.append({
+            "email": email,
+            "password": None if hashed else password,
+            "hashed_password": hashed or None,
+            "is_admin": str(record.get("is_admin", "")).strip().lower() in TRUE_VALUES
+        })
+    return rows, invalid
+
+def directory_ids(cur, emails) -> dict:
+    cur.execute("SELECT email, id FROM user_directory WHERE email = ANY(%s)", (list(emails),))
+    return dict(cur.fetchall())
+
+def csv_buffer(rows) -> io.StringIO:
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    return buf
+
+def register_emails(primary, emails) -> dict:
+    """Allocate directory ids for new emails; the caller commits the primary"""
+    with primary.cursor() as cur:
+        cur.copy_expert(
+            "COPY import_users (email) FROM STDIN WITH (FORMAT csv)",
+            csv_buffer([email] for email in emails)
+        )
+        # The unique email index settles rows registered concurrently since the SELECT
+        cur.execute(
+            "INSERT INTO user_directory (email) SELECT email FROM import_users "
+            "ON CONFLICT (email) DO NOTHING RETURNING email, id"
+        )
+        return dict(cur.fetchall())
+
+def missing_users(shard_conns, ids_by_shard: dict) -> set:
+    """Ids with a directory entry but no users row on their shard"""
+    missing = set()
+    for shard, ids in ids_by_shard.items():
+        with shard_conns[shard].cursor() as cur:
+            cur.execute("SELECT id FROM users WHERE id = ANY(%s)", (list(ids),))
+            missing.update(set(ids) - {row[0] for row in cur.fetchall()})
+        shard_conns[shard].commit()
+    return missing
+
+def copy_users(shard_conns, rows_by_shard: dict) -> int:
+    """COPY users to their shards, skipping any already there; commits each shard"""
+    inserted = 0
+    for shard, shard_rows in rows_by_shard.items():
+        conn = shard_conns[shard]
+        with conn.cursor() as cur:
+            cur.copy_expert(
+                "COPY import_shard_users (id, email, hashed_password, is_admin) FROM STDIN WITH (FORMAT csv)",
+                csv_buffer(shard_rows)
+            )
+            cur.execute(
+                "INSERT INTO users (id, email, hashed_password, is_admin) "
+                "SELECT id, email, hashed_password, is_admin FROM import_shard_users "
+                "ON CONFLICT DO NOTHING"
+            )
+            inserted += cur.rowcount
+        conn.commit()
+    return inserted
+
+def import_chunk(primary, shard_conns, ring: HashRing, pins: dict, rows, pool, workers: int) -> int:
+    """Register and store one chunk of prepared rows; returns the users inserted"""
+    with primary.cursor() as cur:
+        ids = directory_ids(cur, (row["email"] for row in rows))
+    fresh = [row["email"] for row in rows if row["email"] not in ids]
+    new_ids = register_emails(primary, fresh) if fresh else {}
+    primary.commit()
+
+    # Directory entries that existed before this chunk may lack their users row
+    # if an earlier run stopped between the directory and shard commits
+    ids_by_shard = {}
+    for user_id in ids.values():
+        ids_by_shard.setdefault(pins.get(user_id) or ring.node_for(user_id), []).append(user_id)
+    missing = missing_users(shard_conns, ids_by_shard) if ids_by_shard else set()
+
+    ids.update(new_ids)
+    to_store = [row for row in rows if row["email"] in new_ids or ids.get(row["email"]) in missing]
+
+    # Only rows that will actually be inserted pay for bcrypt
+    to_hash = [row for row in to_store if row["hashed_password"] is None]
+    hashes = pool.map(
+        get_password_hash,
+        [row["password"] for row in to_hash],
+        chunksize=max(1, len(to_hash) // (workers * 4))
+    )
+    for row, hashed in zip(to_hash, hashes):
+        row["hashed_password"] = hashed
+
+    rows_by_shard = {}
+    for row in to_store:
+        user_id = ids[row["email"]]
+        rows_by_shard.setdefault(pins.get(user_id) or ring.node_for(user_id), []).append(
+            [user_id, row["email"], row["hashed_password"], "t" if row["is_admin"] else "f"]
+        )
+    return copy_users(shard_conns, rows_by_shard)
+
+def run_import(path: str, fmt: str, start: int, chunk_size: int, workers: int, dsn: str, shard_dsns):
+    conn = psycopg2.connect(dsn)
+    # Shard names follow ShardRouter: position in the list, reusing the primary connection
+    shard_conns = {
+        f"shard{i}": conn if shard_dsn == dsn else psycopg2.connect(shard_dsn)
+        for i, shard_dsn in enumerate(shard_dsns)
+    }
+    ring = HashRing(list(shard_conns), settings.SHARD_VNODES)
+    totals = {"read": 0, "inserted": 0, "existing": 0, "invalid": 0}
+    offset = start
+    started = time.monotonic()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE import_users (email text) ON COMMIT DELETE ROWS")
+            cur.execute("SELECT user_id, shard FROM shard_pins")
+            pins = dict(cur.fetchall())
+        for shard_conn in shard_conns.values():
+            with shard_conn.cursor() as cur:
+                cur.execute(
+                    "CREATE TEMP TABLE import_shard_users "
+                    "(id integer, email text, hashed_password text, is_admin boolean) ON COMMIT DELETE ROWS"
+                )
+            shard_conn.commit()
+        conn.commit()
+
+        records = read_records(path, fmt, start)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+
+                rows, invalid = prepare_chunk(chunk)
+                inserted = import_chunk(conn, shard_conns, ring, pins, rows, pool, workers) if rows else 0
+
+                offset += len(chunk)
+                totals["read"] += len(chunk)
+                totals["inserted"] += inserted
+                totals["existing"] += len(rows) - inserted
+                totals["invalid"] += invalid
+                elapsed = time.monotonic() - started
+                print(
+                    f"next offset {offset}: read {totals['read']}, inserted {totals['inserted']}, "
+                    f"existing {totals['existing']}, invalid {totals['invalid']} "
+                    f"({totals['read'] / elapsed:.0f} records/s)",
+                    file=sys.stderr
+                )
+    finally:
+        for shard_conn in shard_conns.values():
+            if shard_conn is not conn:
+                shard_conn.close()
+        conn.close()
+
+    return totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import users from CSV or NDJSON")
+    parser.add_argument("path", help="Input file (.csv or .ndjson/.jsonl)")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="Input format (default: from extension)")
+    parser.add_argument("--start-line", type=int, default=0, help="Skip this many records (resume offset)")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Records per COPY/commit")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Password hashing processes")
+    parser.add_argument("--database-url", default=settings.DATABASE_URL, help="Target database")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    started = time.monotonic()
+    shard_dsns = [
+        sync_dsn(url) for url in parse_shard_urls(settings.SHARD_DATABASE_URLS, args.database_url)
+    ]
+    totals = run_import(
+        args.path, fmt, args.start_line, args.chunk_size, args.workers,
+        sync_dsn(args.database_url), shard_dsns
+    )
+    elapsed = time.monotonic() - started
+    print(
+        f"done: {totals['inserted']} inserted, {totals['existing']} already present, "
+        f"{totals['invalid']} invalid in {elapsed:.1f}s",
+        file=sys.stderr
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Structured, non-blocking logging.
+
+Records are turned into JSON lines carrying the request id, user id and
+route of the request that produced them. Handlers on the event loop only
+push records onto a bounded queue; a background listener thread does the
+formatting and writing. When the queue is full the record is dropped and
+counted instead of blocking the caller.
+
+LOG_SAMPLING keeps a fraction of sub-WARNING records per logger, e.g.
+``sqlalchemy.engine=0.01,uvicorn.access=0.1``. Naming a logger there also
+enables it at INFO, which is how SQL logging is turned on in production.
+"""
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from app.config import settings
+
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+user_id_var: ContextVar[Optional[int]] = ContextVar("user_id", default=None)
+# Endpoints run in a copy of the middleware's context, so a user id set there
+# only reaches the access record through this shared per-request dict
+_request_user: ContextVar[Optional[dict]] = ContextVar("request_user", default=None)
+route_var: ContextVar[Optional[str]] = ContextVar("route", default=None)
+
+logger = logging.getLogger("app.access")
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "user_id": getattr(record, "user_id", None),
+            "route": getattr(record, "route", None),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keep a configured fraction of sub-WARNING records per logger name prefix"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        # Longest prefix first so 'sqlalchemy.engine' wins over 'sqlalchemy'
+        self.rates = sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        for name, rate in self.rates:
+            if record.name == name or record.name.startswith(name + "."):
+                return rate >= 1.0 or random.random() < rate
+        return True
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queue records for the writer thread; drop and count them when it falls behind"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only the cheap, context-dependent work happens on the caller's thread;
+        # JSON encoding and I/O are left to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.request_id = request_id_var.get()
+        record.user_id = current_user_id()
+        record.route = route_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def parse_sampling(spec: str) -> Dict[str, float]:
+    """Parse 'logger=rate,logger=rate' into a dict"""
+    rates = {}
+    for part in spec.split(","):
+        name, _, rate = part.strip().partition("=")
+        if name and rate:
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+queue_handler: Optional[NonBlockingQueueHandler] = None
+_listener: Optional[QueueListener] = None
+
+def configure_logging():
+    """Route every logger through the JSON queue pipeline"""
+    global queue_handler, _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    rates = parse_sampling(settings.LOG_SAMPLING)
+    queue_handler.addFilter(SamplingFilter(rates))
+
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    _listener = QueueListener(log_queue, writer, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(settings.LOG_LEVEL.upper())
+
+    # uvicorn installs its own synchronous handlers; send its records through ours
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+
+    for name, rate in rates.items():
+        if rate > 0:
+            logging.getLogger(name).setLevel(logging.INFO)
+
+def set_user_id(user_id: int):
+    """Tag the rest of the request's log records, including its access record, with user_id"""
+    user_id_var.set(user_id)
+    holder = _request_user.get()
+    if holder is not None:
+        holder["user_id"] = user_id
+
+def current_user_id() -> Optional[int]:
+    user_id = user_id_var.get()
+    if user_id is None:
+        holder = _request_user.get()
+        user_id = holder.get("user_id") if holder else None
+    return user_id
+
+def stats() -> dict:
+    return {
+        "dropped": queue_handler.dropped if queue_handler else 0,
+        "queued": queue_handler.queue.qsize() if queue_handler else 0,
+        "queue_size": settings.LOG_QUEUE_SIZE
+    }
+
+async def log_context(request, call_next):
+    """HTTP middleware: tag log records with the request id and route"""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    request_id_token = request_id_var.set(request_id)
+    route_token = route_var.set(f"{request.method} {request.url.path}")
+    user_token = _request_user.set({})
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id
+        logger.info(
+            "request completed",
+            extra={"fields": {
+                "status": response.status_code,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 3)
+            }}
+        )
+        return response
+    finally:
+        request_id_var.reset(request_id_token)
+        route_var.reset(route_token)
+        _request_user.reset(user_token)
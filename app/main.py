@@ -1,14 +1,38 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routes import auth as auth_router
 from app.routes import users as users_router
 from app.routes import vpn as vpn_router
 from app.routes import ads as ads_router
-from app.database import engine
-from app.models import Base
+from app.routes import admin as admin_router
+from app.database import engine, AsyncSessionLocal, shards
+from app.models import Base, GLOBAL_TABLES, SHARDED_TABLES
+from app.config import settings
+from app.idempotency import purge_expired_keys
+from app.frequency import capper, impression_sync
+from app import profiling
+from app.log import configure_logging, log_context
+from app import caching
+
+configure_logging()
 
 app = FastAPI(title="ModernVPN Control Plane")
 
+# Registered before CORS so cached responses still get CORS headers
+caching.cache_route(
+    '/ads/',
+    variant=ads_router.ads_cache_variant,
+    cache_control=ads_router.ads_cache_control
+)
+caching.cache_route(
+    '/vpn/servers',
+    variant=lambda request: (),
+    cache_control=vpn_router.servers_cache_control,
+    requires_auth=True
+)
+app.middleware("http")(caching.catalog_cache)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -17,16 +41,84 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+for shard_engine in {engine, *shards.engines.values()}:
+    profiling.install(shard_engine)
+app.middleware("http")(profiling.profile_request)
+app.middleware("http")(log_context)
+
 @app.on_event("startup")
 async def startup():
     # create DB tables (simple approach for dev)
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(Base.metadata.create_all, tables=GLOBAL_TABLES)
+    for shard_engine in shards.engines.values():
+        async with shard_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all, tables=SHARDED_TABLES)
+    
+    async with AsyncSessionLocal() as session:
+        await shards.refresh_pins(session)
+    app.state.idempotency_purge_task = asyncio.create_task(purge_idempotency_keys())
+    app.state.refresh_token_purge_task = asyncio.create_task(purge_refresh_tokens())
+    app.state.shard_pin_task = asyncio.create_task(refresh_shard_pins())
+    app.state.impression_sync_task = asyncio.create_task(sync_impressions())
+    app.state.server_pool_task = asyncio.create_task(refresh_server_pools())
+
+async def refresh_shard_pins():
+    """Pick up users pinned or unpinned by a running rebalance"""
+    while True:
+        await asyncio.sleep(settings.SHARD_PIN_REFRESH_SECONDS)
+        try:
+            async with AsyncSessionLocal() as session:
+                await shards.refresh_pins(session)
+        except Exception:
+            pass
+
+async def sync_impressions():
+    """Count impressions ingested by other workers towards the frequency caps"""
+    while True:
+        for name in shards.names:
+            try:
+                async with shards.sessionmakers[name]() as session:
+                    await impression_sync.poll(name, session)
+            except Exception:
+                pass
+        capper.evict()
+        await asyncio.sleep(settings.FREQ_CAP_SYNC_SECONDS)
+
+async def refresh_server_pools():
+    """Keep /vpn/recommend's address-pool usage fresh without querying per request"""
+    while True:
+        try:
+            await vpn_router.refresh_assigned_counts()
+        except Exception:
+            pass
+        await asyncio.sleep(settings.RECOMMEND_POOL_REFRESH_SECONDS)
+
+async def purge_idempotency_keys():
+    """Periodically drop expired idempotency records"""
+    while True:
+        try:
+            async with AsyncSessionLocal() as session:
+                await purge_expired_keys(session)
+        except Exception:
+            pass
+        await asyncio.sleep(3600)
+
+async def purge_refresh_tokens():
+    """Periodically drop refresh token chains that have fully expired"""
+    while True:
+        try:
+            async with AsyncSessionLocal() as session:
+                await auth_router.purge_expired_refresh_tokens(session)
+        except Exception:
+            pass
+        await asyncio.sleep(3600)
 
 app.include_router(auth_router.router)
 app.include_router(users_router.router)
 app.include_router(vpn_router.router)
 app.include_router(ads_router.router)
+app.include_router(admin_router.router)
 
 @app.get("/health")
 async def health():
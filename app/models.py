@@ -1,9 +1,17 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, JSON, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 
 Base = declarative_base()
 
+class UserDirectory(Base):
+    """Global email -> user id map; allocates user ids across all shards"""
+    __tablename__ = 'user_directory'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    email = Column(String, unique=True, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -30,5 +38,68 @@ class AdEvent(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, index=True)
     event_type = Column(String)  # 'view', 'click', 'conversion'
-    metadata = Column(JSON)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    # 'metadata' is reserved on declarative classes, so map it under another name
+    event_metadata = Column('metadata', JSON)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+class RefreshToken(Base):
+    __tablename__ = 'refresh_tokens'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    family_id = Column(String, index=True)  # shared by every token in one rotation chain
+    token_hash = Column(String, unique=True, index=True)
+    expires_at = Column(DateTime(timezone=True))
+    revoked_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_keys'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, unique=True, index=True)  # '<scope>:<Idempotency-Key header>'
+    fingerprint = Column(String)
+    status_code = Column(Integer, nullable=True)  # NULL while the first request is in flight
+    claimed_at = Column(DateTime(timezone=True), nullable=True)  # when the in-flight attempt started
+    response_body = Column(Text, nullable=True)
+    expires_at = Column(DateTime(timezone=True), index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ShardPin(Base):
+    """Overrides the hash ring for a user while their rows move between shards"""
+    __tablename__ = 'shard_pins'
+    
+    user_id = Column(Integer, primary_key=True)
+    shard = Column(String)  # where requests for the user are routed
+    source = Column(String, nullable=True)  # set once routing has flipped but the old copy remains
+    copied_ids = Column(JSON, nullable=True)  # per table: source row id -> id of its copy on the new shard
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), index=True)
+
+class ShardPlan(Base):
+    """A shard list change planned by ``app.rebalance plan`` whose moves have not finished"""
+    __tablename__ = 'shard_plans'
+    
+    id = Column(Integer, primary_key=True)
+    shard_urls = Column(Text)
+    previous_shard_count = Column(Integer)  # shards before the change; new users are placed on these
+    pins_version = Column(Integer, default=0)  # bumped whenever pins are deleted
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# Tables kept once on the primary database
+GLOBAL_TABLES = [
+    UserDirectory.__table__,
+    RefreshToken.__table__,
+    IdempotencyKey.__table__,
+    ShardPin.__table__,
+    ShardPlan.__table__,
+]
+
+# Tables partitioned by user id across the shard databases
+SHARDED_TABLES = [
+    User.__table__,
+    VPNConfig.__table__,
+    AdEvent.__table__,
+]
@@ -0,0 +1,183 @@
+"""Opt-in per-request profiling.
+
+A request is profiled when an admin sends ``X-Profile: 1`` (or ``X-Profile: cpu``
+to also sample the call stack), or when it is picked by PROFILE_SAMPLE_RATE.
+SQL statements are counted and timed through engine events; a statement that
+runs PROFILE_N_PLUS_ONE_THRESHOLD times or more in one request is reported as
+an N+1 candidate. Admin-requested profiles are summarized in the ``X-Profile``
+response header, and every profile is kept in a bounded ring buffer served by
+``GET /admin/profiles``.
+"""
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+from app.auth import bearer_claims
+from app.config import settings
+
+_current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("request_profile", default=None)
+
+recent_profiles = deque(maxlen=settings.PROFILE_BUFFER_SIZE)
+
+class StackSampler(threading.Thread):
+    """Sample the stack of one thread at a fixed interval.
+
+    Everything running on the event loop thread is sampled, so concurrent
+    requests show up in each other's profiles; sample quiet periods when
+    the numbers need to be precise.
+    """
+
+    _active = threading.Lock()
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        StackSampler._active.release()
+
+    @classmethod
+    def start_for_current_thread(cls, interval: float) -> Optional["StackSampler"]:
+        # One sampler at a time: overlapping samplers would only duplicate work
+        if not cls._active.acquire(blocking=False):
+            return None
+        sampler = cls(threading.get_ident(), interval)
+        sampler.start()
+        return sampler
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, cpu: bool = False):
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.total_ms = 0.0
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self.statements = {}  # statement -> [count, total ms]
+        self.sampler = (
+            StackSampler.start_for_current_thread(settings.PROFILE_CPU_INTERVAL_MS / 1000)
+            if cpu else None
+        )
+        self.stacks = None
+
+    def record(self, statement: str, elapsed_ms: float):
+        self.sql_count += 1
+        self.sql_ms += elapsed_ms
+        entry = self.statements.get(statement)
+        if entry is None:
+            self.statements[statement] = [1, elapsed_ms]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed_ms
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self._started) * 1000
+        if self.sampler:
+            self.sampler.stop()
+            self.stacks = [
+                {"stack": stack, "samples": count}
+                for stack, count in self.sampler.stacks.most_common(20)
+            ]
+
+    def n_plus_one(self):
+        return [
+            {"statement": statement, "count": count, "ms": round(ms, 3)}
+            for statement, (count, ms) in self.statements.items()
+            if count >= settings.PROFILE_N_PLUS_ONE_THRESHOLD
+        ]
+
+    def header_value(self) -> str:
+        return (
+            f"total_ms={self.total_ms:.1f};sql={self.sql_count};"
+            f"sql_ms={self.sql_ms:.1f};n_plus_one={len(self.n_plus_one())}"
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at,
+            "total_ms": round(self.total_ms, 3),
+            "sql_count": self.sql_count,
+            "sql_ms": round(self.sql_ms, 3),
+            "n_plus_one": self.n_plus_one(),
+            "statements": [
+                {"statement": statement, "count": count, "ms": round(ms, 3)}
+                for statement, (count, ms) in sorted(
+                    self.statements.items(), key=lambda item: item[1][1], reverse=True
+                )
+            ],
+            "cpu_samples": self.stacks
+        }
+
+def install(engine):
+    """Time SQL statements executed while a request profile is active"""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current_profile.get() is not None:
+            conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        started = conn.info.get("profile_started")
+        if profile is not None and started:
+            profile.record(statement, (time.perf_counter() - started.pop()) * 1000)
+
+def requested_mode(request) -> Optional[str]:
+    """'header' or 'cpu' for an admin X-Profile request, 'sampled' if sampled, else None"""
+    flag = request.headers.get("x-profile")
+    if flag:
+        if bearer_claims(request).get("is_admin"):
+            return "cpu" if flag.lower() == "cpu" else "header"
+
+    if settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+async def profile_request(request, call_next):
+    """HTTP middleware: run the request under a profile when asked to"""
+    mode = requested_mode(request)
+    if mode is None:
+        return await call_next(request)
+
+    profile = RequestProfile(request.method, request.url.path, cpu=(mode == "cpu"))
+    token = _current_profile.set(profile)
+    try:
+        response = await call_next(request)
+    finally:
+        _current_profile.reset(token)
+        profile.finish()
+        recent_profiles.append(profile.to_dict())
+
+    if mode != "sampled":
+        response.headers["X-Profile"] = profile.header_value()
+    return response
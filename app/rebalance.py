@@ -0,0 +1,255 @@
+"""Online shard maintenance.
+
+    python -m app.rebalance backfill-directory
+    python -m app.rebalance plan --new-urls URL0,URL1,URL2
+    python -m app.rebalance move --batch-size 500
+
+Adding a shard:
+
+1. ``plan`` with the new URL list (the current list plus the new shards
+   appended). Every user whose ring position changes is pinned to the shard
+   that holds their rows today, so nothing moves yet. Until ``move``
+   finishes, users registered by any worker are created on their shard
+   under the old list and pinned there, so old- and new-list workers agree
+   on where they live.
+2. Deploy with SHARD_DATABASE_URLS set to the new list. Routing follows the
+   pins, so requests still find every user.
+3. ``move`` copies each pinned user to their new shard, flips the pin, waits
+   for workers to pick the flip up, diffs the old copy against what was
+   copied (copying rows written in the meantime and dropping configs deleted
+   meanwhile), deletes the old copy and drops the pin. It can be
+   interrupted and re-run.
+
+``backfill-directory`` fills ``user_directory`` from existing ``users`` rows;
+run it once when upgrading a database created before sharding.
+"""
+import argparse
+import asyncio
+import sys
+from typing import Callable, Dict, Iterable
+
+from sqlalchemy import delete, func, insert, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.config import settings
+from app.database import AsyncSessionLocal, engine, shards
+from app.models import AdEvent, ShardPin, ShardPlan, User, UserDirectory, VPNConfig
+from app.sharding import ShardRouter, parse_shard_urls
+
+COPY_BATCH_SIZE = 1000
+
+async def copy_user_rows(
+    src: AsyncSession, dst: AsyncSession, model, user_id: int,
+    ids: Iterable[int] = None, keep: Callable[[dict], bool] = None
+) -> Dict[int, int]:
+    """Copy a user's rows (only the given source ids, if any); returns source id -> copy id.
+
+    Child rows get fresh ids on the destination shard; rows failing keep are skipped.
+    """
+    table = model.__table__
+    query = select(table).where(table.c.user_id == user_id)
+    if ids is not None:
+        query = query.where(table.c.id.in_(list(ids)))
+    result = await src.stream(query.order_by(table.c.id).execution_options(yield_per=COPY_BATCH_SIZE))
+    copied = {}
+    async for batch in result.partitions():
+        rows = [dict(row._mapping) for row in batch]
+        if keep is not None:
+            rows = [row for row in rows if keep(row)]
+        if not rows:
+            continue
+        source_ids = [row.pop("id") for row in rows]
+        inserted = await dst.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows)
+        copied.update(zip(source_ids, inserted.scalars().all()))
+    return copied
+
+async def delete_user_rows(session: AsyncSession, user_id: int):
+    await session.execute(delete(AdEvent).where(AdEvent.user_id == user_id))
+    await session.execute(delete(VPNConfig).where(VPNConfig.user_id == user_id))
+    await session.execute(delete(User).where(User.id == user_id))
+
+async def copy_user(pin: ShardPin, target: str):
+    """Copy a pinned user's rows to target while requests still go to pin.shard"""
+    async with shards.sessionmakers[pin.shard]() as src, shards.sessionmakers[target]() as dst:
+        result = await src.execute(select(User.__table__).where(User.id == pin.user_id))
+        user_row = result.first()
+
+        # Drop leftovers of an interrupted attempt; target gets no traffic for this user yet
+        await delete_user_rows(dst, pin.user_id)
+        if user_row is not None:
+            await dst.execute(insert(User.__table__), [dict(user_row._mapping)])
+        pin.copied_ids = {
+            model.__tablename__: await copy_user_rows(src, dst, model, pin.user_id)
+            for model in (VPNConfig, AdEvent)
+        }
+        await dst.commit()
+
+    pin.source, pin.shard = pin.shard, target
+
+async def finish_user(primary: AsyncSession, pin: ShardPin):
+    """Bring the new copy in line with the old shard, then remove the old copy.
+
+    The user's rows on the old shard are diffed against the ones copied: rows
+    written there since the copy are copied over whatever their ids, and
+    configs deleted there since the copy are deleted from the new copy too.
+    """
+    copied_ids = dict(pin.copied_ids or {})
+    async with shards.sessionmakers[pin.source]() as src, shards.sessionmakers[pin.shard]() as dst:
+        for model in (VPNConfig, AdEvent):
+            table = model.__table__
+            # JSON object keys come back as strings
+            copied = {int(source_id): copy_id for source_id, copy_id in copied_ids.get(table.name, {}).items()}
+            result = await src.execute(select(table.c.id).where(table.c.user_id == pin.user_id))
+            current = set(result.scalars().all())
+
+            removed = [copied.pop(source_id) for source_id in copied.keys() - current]
+            if removed:
+                await dst.execute(delete(table).where(table.c.id.in_(removed)))
+
+            late = current - copied.keys()
+            if late:
+                keep = None
+                if model is VPNConfig:
+                    result = await dst.execute(select(VPNConfig.server_id).where(VPNConfig.user_id == pin.user_id))
+                    known_servers = set(result.scalars().all())
+                    keep = lambda row: row["server_id"] not in known_servers
+                copied.update(await copy_user_rows(src, dst, model, pin.user_id, late, keep))
+            copied_ids[table.name] = copied
+        await dst.commit()
+
+        # Record what the new copy holds before the old one goes, so a re-run copies nothing twice
+        pin.copied_ids = copied_ids
+        await primary.commit()
+        await delete_user_rows(src, pin.user_id)
+        await src.commit()
+
+async def backfill_directory():
+    total = 0
+    for name in shards.names:
+        async with shards.sessionmakers[name]() as src, AsyncSessionLocal() as primary:
+            result = await src.stream(
+                select(User.id, User.email).order_by(User.id).execution_options(yield_per=COPY_BATCH_SIZE)
+            )
+            async for batch in result.partitions():
+                ids = [user_id for user_id, _ in batch]
+                known = await primary.execute(select(UserDirectory.id).where(UserDirectory.id.in_(ids)))
+                known = set(known.scalars().all())
+                rows = [{"id": user_id, "email": email} for user_id, email in batch if user_id not in known]
+                if rows:
+                    await primary.execute(insert(UserDirectory.__table__), rows)
+                    total += len(rows)
+            await primary.commit()
+
+    if engine.dialect.name == "postgresql":
+        # Explicit ids do not advance the sequence; new users must not reuse them
+        async with engine.begin() as conn:
+            await conn.execute(text(
+                "SELECT setval(pg_get_serial_sequence('user_directory', 'id'), "
+                "(SELECT COALESCE(MAX(id), 1) FROM user_directory))"
+            ))
+    print(f"backfilled {total} directory entries", file=sys.stderr)
+
+async def plan(new_urls, grace: float):
+    old_urls = parse_shard_urls(settings.SHARD_DATABASE_URLS, settings.DATABASE_URL)
+    if new_urls[:len(old_urls)] != old_urls:
+        raise SystemExit("new shard list must start with the current SHARD_DATABASE_URLS, in order")
+    new_router = ShardRouter(new_urls, primary=engine, primary_url=settings.DATABASE_URL, vnodes=settings.SHARD_VNODES)
+
+    async with AsyncSessionLocal() as primary:
+        # From here on registrations pin themselves; let those already past that check land
+        primary.add(ShardPlan(shard_urls=",".join(new_urls), previous_shard_count=len(old_urls)))
+        await primary.commit()
+    await asyncio.sleep(grace)
+
+    pinned = 0
+    async with AsyncSessionLocal() as primary:
+        for name in shards.names:
+            async with shards.sessionmakers[name]() as src:
+                result = await src.stream(
+                    select(User.id).order_by(User.id).execution_options(yield_per=COPY_BATCH_SIZE)
+                )
+                async for batch in result.partitions():
+                    ids = [user_id for (user_id,) in batch if new_router.ring.node_for(user_id) != name]
+                    if not ids:
+                        continue
+                    known = await primary.execute(select(ShardPin.user_id).where(ShardPin.user_id.in_(ids)))
+                    known = set(known.scalars().all())
+                    pins = [
+                        {"user_id": user_id, "shard": name}
+                        for user_id in ids if user_id not in known
+                    ]
+                    if pins:
+                        await primary.execute(insert(ShardPin.__table__), pins)
+                        await primary.commit()
+                        pinned += len(pins)
+
+    print(
+        f"pinned {pinned} users to their current shard; "
+        f"deploy SHARD_DATABASE_URLS={','.join(new_urls)} and run 'move'",
+        file=sys.stderr
+    )
+
+async def move(batch_size: int, grace: float):
+    moved = 0
+    while True:
+        async with AsyncSessionLocal() as primary:
+            result = await primary.execute(select(ShardPin).order_by(ShardPin.user_id).limit(batch_size))
+            pins = result.scalars().all()
+            if not pins:
+                break
+
+            # Phase 1: copy while requests still go to the old shard, then flip routing
+            for pin in pins:
+                target = shards.ring.node_for(pin.user_id)
+                if pin.source is None and pin.shard != target:
+                    await copy_user(pin, target)
+                    await primary.commit()
+
+            # Phase 2: once every worker routes to the new shard, catch up and clean up
+            if any(pin.source for pin in pins):
+                await asyncio.sleep(grace)
+            for pin in pins:
+                if pin.source:
+                    await finish_user(primary, pin)
+                await primary.delete(pin)
+                await primary.commit()
+                moved += 1
+            # Workers load pins incrementally and reload them all when the version changes
+            await primary.execute(update(ShardPlan).values(pins_version=func.coalesce(ShardPlan.pins_version, 0) + 1))
+            await primary.commit()
+
+        print(f"moved {moved} users", file=sys.stderr)
+
+    async with AsyncSessionLocal() as primary:
+        await primary.execute(delete(ShardPlan))
+        await primary.commit()
+    print(f"done: {moved} users moved", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shard maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backfill-directory", help="Fill user_directory from existing users")
+    plan_parser = commands.add_parser("plan", help="Pin users whose shard changes under a new shard list")
+    plan_parser.add_argument("--new-urls", required=True, help="Comma-separated new SHARD_DATABASE_URLS")
+    plan_parser.add_argument(
+        "--grace", type=float, default=5.0,
+        help="Seconds to let in-flight registrations finish before scanning"
+    )
+    move_parser = commands.add_parser("move", help="Move pinned users to their ring shard")
+    move_parser.add_argument("--batch-size", type=int, default=500)
+    move_parser.add_argument(
+        "--grace", type=float, default=settings.SHARD_PIN_REFRESH_SECONDS * 2,
+        help="Seconds to wait for workers to reload pins after a flip"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill-directory":
+        asyncio.run(backfill_directory())
+    elif args.command == "plan":
+        asyncio.run(plan(parse_shard_urls(args.new_urls, settings.DATABASE_URL), args.grace))
+    else:
+        asyncio.run(move(args.batch_size, args.grace))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import ipaddress
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Approximate coordinates (lat, lon) of server locations
+CITY_COORDINATES = {
+    ("US", "Virginia"): (38.03, -78.48),
+    ("US", "California"): (37.77, -122.42),
+    ("DE", "Frankfurt"): (50.11, 8.68),
+    ("IN", "Mumbai"): (19.08, 72.88),
+    ("SE", "Stockholm"): (59.33, 18.07),
+}
+
+# Rough population-weighted centroids used for client and fallback server positions
+COUNTRY_CENTROIDS = {
+    "AE": (24.45, 54.38), "AR": (-34.60, -58.38), "AU": (-33.87, 151.21),
+    "BR": (-23.55, -46.63), "CA": (43.65, -79.38), "CH": (47.38, 8.54),
+    "CN": (31.23, 121.47), "DE": (50.11, 8.68), "ES": (40.42, -3.70),
+    "FR": (48.86, 2.35), "GB": (51.51, -0.13), "ID": (-6.21, 106.85),
+    "IN": (21.15, 79.09), "IT": (41.90, 12.50), "JP": (35.68, 139.69),
+    "KR": (37.57, 126.98), "MX": (19.43, -99.13), "NG": (6.52, 3.38),
+    "NL": (52.37, 4.90), "PK": (24.86, 67.01), "PL": (52.23, 21.01),
+    "RU": (55.76, 37.62), "SE": (59.33, 18.07), "SG": (1.35, 103.82),
+    "TR": (41.01, 28.98), "US": (39.83, -98.58), "ZA": (-26.20, 28.05),
+}
+
+EARTH_RADIUS_KM = 6371.0
+MAX_DISTANCE_KM = 20015.0  # half the equatorial circumference
+RTT_CEILING_MS = 300.0
+
+DEFAULT_WEIGHTS = {"distance": 0.35, "rtt": 0.25, "load": 0.25, "headroom": 0.15}
+
+class ServerCatalog:
+    """Column-oriented snapshot of the server list for vectorized scoring"""
+
+    def __init__(self, servers: List[dict], networks: Dict[str, str], default_network: str):
+        self.servers = list(servers)
+        self.index = {s["id"]: i for i, s in enumerate(self.servers)}
+
+        coords = np.array(
+            [
+                CITY_COORDINATES.get(
+                    (s["country"], s["city"]),
+                    COUNTRY_CENTROIDS.get(s["country"], (np.nan, np.nan))
+                )
+                for s in self.servers
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        self.lat = np.radians(coords[:, 0])
+        self.lon = np.radians(coords[:, 1])
+        self.rtt = np.array([s.get("ping", RTT_CEILING_MS) for s in self.servers], dtype=np.float64)
+        self.load = np.array([s.get("load", 100) for s in self.servers], dtype=np.float64)
+        self.online = np.array([s["status"] == "online" for s in self.servers], dtype=bool)
+        # Usable host addresses: minus network, broadcast and the server's own address
+        self.pool_size = np.array(
+            [
+                max(ipaddress.IPv4Network(networks.get(s["id"], default_network)).num_addresses - 3, 1)
+                for s in self.servers
+            ],
+            dtype=np.float64,
+        )
+        self.assigned = np.zeros(len(self.servers), dtype=np.float64)
+        self.assigned_at = 0.0
+
+    def update_assigned(self, counts: Dict[str, int]):
+        """Replace per-server counts of allocated client addresses"""
+        assigned = np.zeros(len(self.servers), dtype=np.float64)
+        for server_id, count in counts.items():
+            i = self.index.get(server_id)
+            if i is not None:
+                assigned[i] = count
+        self.assigned = assigned
+        self.assigned_at = time.monotonic()
+
+    def distances_km(self, lat: float, lon: float) -> np.ndarray:
+        """Great-circle distance from a point to every server (haversine)"""
+        lat, lon = np.radians(lat), np.radians(lon)
+        a = (
+            np.sin((self.lat - lat) / 2) ** 2
+            + np.cos(lat) * np.cos(self.lat) * np.sin((self.lon - lon) / 2) ** 2
+        )
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    def score(self, origin: Optional[Tuple[float, float]], weights: Dict[str, float] = None):
+        """Return (scores, distances) for every server; offline servers score -inf"""
+        weights = weights or DEFAULT_WEIGHTS
+
+        if origin is not None:
+            distance = self.distances_km(*origin)
+            proximity = 1.0 - np.minimum(np.nan_to_num(distance, nan=MAX_DISTANCE_KM) / MAX_DISTANCE_KM, 1.0)
+        else:
+            # Unknown client location: distance cannot separate servers
+            distance = np.full(len(self.servers), np.nan)
+            proximity = np.zeros(len(self.servers))
+
+        latency = 1.0 - np.minimum(self.rtt / RTT_CEILING_MS, 1.0)
+        spare_load = 1.0 - np.clip(self.load / 100.0, 0.0, 1.0)
+        headroom = 1.0 - np.clip(self.assigned / self.pool_size, 0.0, 1.0)
+
+        scores = (
+            weights["distance"] * proximity
+            + weights["rtt"] * latency
+            + weights["load"] * spare_load
+            + weights["headroom"] * headroom
+        )
+        # A full address pool cannot take another client
+        scores = np.where(self.online & (headroom > 0), scores, -np.inf)
+        return scores, distance
+
+    def top(self, n: int, origin: Optional[Tuple[float, float]]) -> List[dict]:
+        """Best n servers for a client at origin, highest score first"""
+        scores, distance = self.score(origin)
+        n = min(n, int(np.isfinite(scores).sum()))
+        if n <= 0:
+            return []
+
+        best = np.argpartition(-scores, n - 1)[:n]
+        best = best[np.argsort(-scores[best])]
+        return [
+            {
+                **self.servers[i],
+                "score": round(float(scores[i]), 4),
+                "distance_km": None if np.isnan(distance[i]) else round(float(distance[i]), 1),
+            }
+            for i in best
+        ]
@@ -1,9 +1,87 @@
-from fastapi import APIRouter, Depends
-from app.auth import get_current_user
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import func
+from sqlalchemy.future import select
+from app.routes.auth import get_token_user
+from app.schemas import TokenData
+from app import idempotency, profiling, log, frequency, fraud
+from app.database import shards
+from app.models import User, VPNConfig, AdEvent
+from typing import Optional
 
 router = APIRouter(prefix='/admin')
 
+async def require_admin(current_user: TokenData = Depends(get_token_user)) -> TokenData:
+    """Allow only admin callers"""
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return current_user
+
 @router.get('/stats')
-async def stats(current=Depends(get_current_user)):
-    # placeholder — implement admin checks and real stats
-    return {'active_users': 123, 'servers': []}
\ No newline at end of file
+async def stats(current: TokenData = Depends(require_admin)):
+    """User, config and ad event totals across all shards"""
+    async def shard_counts(session):
+        counts = {}
+        for key, model in (('users', User), ('vpn_configs', VPNConfig), ('ad_events', AdEvent)):
+            result = await session.execute(select(func.count(model.id)))
+            counts[key] = result.scalar()
+        result = await session.execute(
+            select(VPNConfig.server_id, func.count(VPNConfig.id)).group_by(VPNConfig.server_id)
+        )
+        counts['servers'] = dict(result.all())
+        return counts
+    
+    per_shard = dict(zip(shards.names, await shards.fan_out(shard_counts)))
+    servers = {}
+    for counts in per_shard.values():
+        for server_id, count in counts['servers'].items():
+            servers[server_id] = servers.get(server_id, 0) + count
+    
+    return {
+        'active_users': sum(c['users'] for c in per_shard.values()),
+        'vpn_configs': sum(c['vpn_configs'] for c in per_shard.values()),
+        'ad_events': sum(c['ad_events'] for c in per_shard.values()),
+        'servers': [{'id': server_id, 'configs': count} for server_id, count in sorted(servers.items())],
+        'shards': {
+            name: {key: value for key, value in counts.items() if key != 'servers'}
+            for name, counts in per_shard.items()
+        }
+    }
+
+@router.get('/idempotency')
+async def idempotency_stats(current: TokenData = Depends(require_admin)):
+    """Footprint and hit rate of the in-memory idempotency cache for this worker"""
+    return idempotency.cache.stats()
+
+@router.get('/profiles')
+async def recent_profiles(
+    path: Optional[str] = Query(None, description="Only profiles for this path"),
+    n_plus_one: bool = Query(False, description="Only profiles with N+1 candidates"),
+    current: TokenData = Depends(require_admin)
+):
+    """Most recent request profiles recorded by this worker, newest first"""
+    profiles = [
+        p for p in reversed(profiling.recent_profiles)
+        if (path is None or p["path"] == path) and (not n_plus_one or p["n_plus_one"])
+    ]
+    return {"profiles": profiles, "total": len(profiles)}
+
+@router.get('/logging')
+async def logging_stats(current: TokenData = Depends(require_admin)):
+    """Log pipeline queue depth and records dropped by this worker"""
+    return log.stats()
+
+@router.get('/frequency')
+async def frequency_stats(current: TokenData = Depends(require_admin)):
+    """Users and (user, ad) counters tracked by this worker's frequency capper"""
+    return {
+        **frequency.capper.stats(),
+        "sync_watermarks": frequency.impression_sync.watermarks
+    }
+
+@router.get('/fraud')
+async def fraud_stats(current: TokenData = Depends(require_admin)):
+    """Ad events accepted and filtered by this worker, and the filters' footprint"""
+    return fraud.event_filter.stats()
@@ -1,11 +1,25 @@
-from fastapi import APIRouter, Depends, Query, HTTPException, status
+from fastapi import APIRouter, Depends, Header, Query, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
 from app.models import AdEvent
-from app.database import get_db
-from app.routes.auth import get_current_user
-from app.models import User
+from app.database import get_db, shards
+from app.routes.auth import get_token_user, get_optional_token_user
+from app.schemas import TokenData
+from app.config import settings
+from app.geoip import resolve_request_country
+from app.idempotency import run_idempotent
+from app.frequency import IMPRESSION_EVENTS, capper, event_ad_id, impression_sync
+from app.auth import bearer_claims
+from app.fraud import event_filter, event_source
+from app.utils import client_ip
+from datetime import datetime
 from typing import Optional, List
 import random
+import json
+import csv
+import io
+import zlib
 
 router = APIRouter(prefix='/ads')
 
@@ -122,14 +136,42 @@ MOCK_ADS = {
     ]
 }
 
+def target_country(request: Request, country: Optional[str]) -> str:
+    """Requested country, else the client's own country, else IN"""
+    return (country or resolve_request_country(request) or "IN").upper()
+
+def ads_cache_variant(request: Request) -> Optional[tuple]:
+    """Catalog cache key for GET /ads/; None once the caller has frequency-capped ads"""
+    user_id = bearer_claims(request).get("user_id")
+    if user_id is not None and capper.capped_ads(user_id):
+        return None
+    params = request.query_params
+    return (
+        target_country(request, params.get("country")),
+        (params.get("category") or "").lower(),
+        params.get("limit", "5")
+    )
+
+def ads_cache_control(request: Request) -> str:
+    # Without an explicit country the response depends on the client's address,
+    # and with a token it omits the user's frequency-capped ads, so shared
+    # caches must not reuse it for other clients
+    shared = request.query_params.get("country") and "authorization" not in request.headers
+    visibility = "public" if shared else "private"
+    return f"{visibility}, max-age={settings.CATALOG_CACHE_TTL}"
+
 @router.get('/')
 async def get_ads(
-    country: str = Query("IN", description="Country code for targeted ads"),
+    request: Request,
+    country: Optional[str] = Query(None, description="Country code for targeted ads (defaults to the client's location)"),
     category: Optional[str] = Query(None, description="Filter by ad category"),
-    limit: int = Query(5, ge=1, le=20, description="Number of ads to return")
+    limit: int = Query(5, ge=1, le=20, description="Number of ads to return"),
+    current_user: Optional[TokenData] = Depends(get_optional_token_user)
 ):
     """Get advertisements targeted by country and category"""
     try:
+        country = target_country(request, country)
+        
         # Get ads for the specified country, fallback to IN (India) if not found
         country_ads = MOCK_ADS.get(country.upper(), MOCK_ADS["IN"])
         
@@ -137,8 +179,12 @@ async def get_ads(
         if category:
             country_ads = [ad for ad in country_ads if ad["category"] == category.lower()]
         
+        # Leave out ads the user has already seen FREQ_CAP_IMPRESSIONS times
+        capped = capper.capped_ads(current_user.id) if current_user else frozenset()
+        eligible_ads = [ad for ad in country_ads if ad["id"] not in capped]
+        
         # Shuffle ads for variety and limit results
-        ads = random.sample(country_ads, min(len(country_ads), limit))
+        ads = random.sample(eligible_ads, min(len(eligible_ads), limit))
         
         return {
             "ads": ads,
@@ -156,19 +202,32 @@ async def get_ads(
 @router.post('/event')
 async def track_ad_event(
     payload: dict, 
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     db: AsyncSession = Depends(get_db),
-    current_user: Optional[User] = Depends(lambda: None)  # Optional authentication
+    current_user: Optional[TokenData] = Depends(get_optional_token_user)
 ):
     """Track advertisement events (impressions, clicks, conversions)"""
+    ip = client_ip(request)
+    # Anonymous clients are told apart by address so their keys cannot collide
+    scope = f"ads.event:{current_user.id}" if current_user else f"ads.event:ip:{ip or 'unknown'}"
+    return await run_idempotent(
+        db,
+        scope,
+        idempotency_key,
+        payload,
+        lambda: record_ad_event(payload, current_user, ip)
+    )
+
+async def record_ad_event(payload: dict, current_user: Optional[TokenData], ip: Optional[str] = None):
+    """Validate, filter and store a single ad event"""
     try:
         # Extract event data
         event_type = payload.get('event_type')
         metadata = payload.get('metadata', {})
-        user_id = payload.get('user_id')
         
-        # Use authenticated user ID if available
-        if current_user:
-            user_id = current_user.id
+        # Only the token says who the user is; anonymous events are attributed to the client address
+        user_id = current_user.id if current_user else None
         
         # Validate event type
         valid_events = ['impression', 'click', 'conversion', 'view', 'close']
@@ -178,16 +237,33 @@ async def track_ad_event(
                 detail=f"Invalid event type. Must be one of: {valid_events}"
             )
         
+        ad_id = event_ad_id(metadata)
+        reason = event_filter.check(event_source(user_id, ip), ad_id, event_type)
+        if reason:
+            # Counted by the filter, not stored, so rollups only see clean events
+            return {
+                "success": True,
+                "event_id": None,
+                "filtered": reason,
+                "message": f"Ad {event_type} not tracked ({reason})"
+            }
+        
         # Create ad event record
         ad_event = AdEvent(
             user_id=user_id,
             event_type=event_type,
-            metadata=metadata
+            event_metadata=metadata
         )
         
-        db.add(ad_event)
-        await db.commit()
-        await db.refresh(ad_event)
+        # Events are stored on the shard of the user they belong to
+        shard = shards.shard_for(user_id)
+        async with shards.sessionmakers[shard]() as db:
+            db.add(ad_event)
+            await db.commit()
+            await db.refresh(ad_event)
+        
+        if event_type in IMPRESSION_EVENTS and user_id is not None and ad_id is not None:
+            impression_sync.record_local(shard, ad_event.id, user_id, ad_id)
         
         return {
             "success": True,
@@ -205,7 +281,7 @@ async def track_ad_event(
 
 @router.get('/stats')
 async def get_ad_stats(
-    current_user: User = Depends(get_current_user),
+    current_user: TokenData = Depends(get_token_user),
     db: AsyncSession = Depends(get_db)
 ):
     """Get advertisement statistics (admin only)"""
@@ -246,4 +322,115 @@ async def get_ad_stats(
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to fetch ad statistics"
-        )
\ No newline at end of file
+        )
+
+EXPORT_COLUMNS = ["id", "user_id", "event_type", "metadata", "created_at"]
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def encode_export_batch(rows, fmt: str) -> bytes:
+    """Serialize a batch of ad event rows as NDJSON lines or CSV records"""
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for event_id, user_id, event_type, metadata, created_at in rows:
+            writer.writerow([
+                event_id,
+                user_id if user_id is not None else "",
+                event_type,
+                json.dumps(metadata) if metadata is not None else "",
+                created_at.isoformat() if created_at else ""
+            ])
+        return buf.getvalue().encode()
+
+    lines = []
+    for event_id, user_id, event_type, metadata, created_at in rows:
+        lines.append(json.dumps({
+            "id": event_id,
+            "user_id": user_id,
+            "event_type": event_type,
+            "metadata": metadata,
+            "created_at": created_at.isoformat() if created_at else None
+        }))
+    return ("\n".join(lines) + "\n").encode()
+
+async def stream_ad_events(query, fmt: str, compress: bool, shard_names: List[str]):
+    """Yield encoded export chunks read from server-side cursors.
+
+    Rows are fetched EXPORT_BATCH_SIZE at a time and the generator is only
+    advanced once the previous chunk has been handed to the client, so memory
+    stays flat and a slow reader throttles the cursor instead of piling up data.
+    Shards are read one after another, each in id order.
+    """
+    # wbits=31 writes a gzip container instead of a raw zlib stream
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    if fmt == "csv":
+        header = (",".join(EXPORT_COLUMNS) + "\r\n").encode()
+        yield compressor.compress(header) if compressor else header
+
+    for name in shard_names:
+        # The request-scoped sessions may be closed before the body is sent,
+        # so each cursor gets a session of its own for the lifetime of the stream
+        async with shards.sessionmakers[name]() as session:
+            result = await session.stream(
+                query.execution_options(yield_per=settings.EXPORT_BATCH_SIZE)
+            )
+            async for batch in result.partitions():
+                chunk = encode_export_batch(batch, fmt)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+
+    if compressor:
+        yield compressor.flush()
+
+@router.get('/events/export')
+async def export_ad_events(
+    fmt: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$", description="Output format"),
+    gzip: bool = Query(False, description="Gzip-compress the export"),
+    start: Optional[datetime] = Query(None, description="Only events created at or after this time"),
+    end: Optional[datetime] = Query(None, description="Only events created before this time"),
+    event_type: Optional[str] = Query(None, description="Filter by event type"),
+    user_id: Optional[int] = Query(None, description="Filter by user"),
+    current_user: TokenData = Depends(get_token_user)
+):
+    """Stream raw ad events as NDJSON or CSV (admin only)"""
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+
+    query = select(
+        AdEvent.id,
+        AdEvent.user_id,
+        AdEvent.event_type,
+        AdEvent.event_metadata,
+        AdEvent.created_at
+    ).order_by(AdEvent.id)
+
+    if start:
+        query = query.filter(AdEvent.created_at >= start)
+    if end:
+        query = query.filter(AdEvent.created_at < end)
+    if event_type:
+        query = query.filter(AdEvent.event_type == event_type)
+    if user_id is not None:
+        query = query.filter(AdEvent.user_id == user_id)
+
+    filename = f"ad_events.{fmt}"
+    media_type = EXPORT_MEDIA_TYPES[fmt]
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+
+    # A single user's events live on one shard; everything else fans out
+    shard_names = [shards.shard_for(user_id)] if user_id is not None else shards.names
+
+    return StreamingResponse(
+        stream_ad_events(query, fmt, gzip, shard_names),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
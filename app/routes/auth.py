@@ -1,24 +1,152 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.future import select
-from app.schemas import UserCreate, UserOut, Token
-from app.database import get_db
-from app.models import User
-from app.auth import verify_password, get_password_hash, create_access_token
-from datetime import timedelta
+from app.schemas import UserCreate, UserOut, Token, TokenData, RefreshRequest
+from app.database import AsyncSessionLocal, get_db, shards
+from app.models import User, UserDirectory, RefreshToken, ShardPin, ShardPlan
+from app.auth import (
+    verify_password,
+    get_password_hash,
+    create_access_token,
+    decode_access_token,
+    create_refresh_token,
+    hash_refresh_token
+)
+from app.utils import random_token
+from app.log import set_user_id
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from jose import JWTError
 from app.config import settings
 
 router = APIRouter(prefix='/auth')
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+def issue_tokens(db: AsyncSession, user: User, family_id: str = None) -> dict:
+    """Create an access token and a new refresh token for the user.
+
+    The refresh token row is added to the session; the caller commits.
+    """
+    access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data={"sub": user.email, "user_id": user.id, "is_admin": bool(user.is_admin)},
+        expires_delta=access_token_expires
+    )
+    
+    refresh_token = create_refresh_token()
+    db.add(RefreshToken(
+        user_id=user.id,
+        family_id=family_id or random_token(16),
+        token_hash=hash_refresh_token(refresh_token),
+        expires_at=datetime.now(timezone.utc) + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
+    ))
+    
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+        "expires_in": int(access_token_expires.total_seconds())
+    }
+
+async def revoke_token_family(db: AsyncSession, family_id: str):
+    """Revoke every still-active refresh token in a rotation chain"""
+    await db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.family_id == family_id, RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=datetime.now(timezone.utc))
+    )
+
+async def purge_expired_refresh_tokens(db: AsyncSession) -> int:
+    """Delete refresh token chains whose every token has expired.
+
+    Revoked tokens are kept while their chain is alive so reuse is still detected.
+    """
+    live_families = select(RefreshToken.family_id).where(RefreshToken.expires_at > datetime.now(timezone.utc))
+    result = await db.execute(
+        delete(RefreshToken).where(RefreshToken.family_id.not_in(live_families))
+    )
+    await db.commit()
+    return result.rowcount
+
+async def load_user(user_id: int):
+    """Load a user row from the shard that holds it"""
+    async with shards.session_for(user_id) as session:
+        result = await session.execute(select(User).filter(User.id == user_id))
+        user = result.scalars().first()
+    if user is None and user_id not in shards.pins:
+        # Registered during a shard plan by another worker since our last pin refresh
+        async with AsyncSessionLocal() as db:
+            shard = await db.scalar(select(ShardPin.shard).where(ShardPin.user_id == user_id))
+        if shard in shards.engines and shard != shards.shard_for(user_id):
+            shards.pins[user_id] = shard
+            return await load_user(user_id)
+    return user
+
+async def find_user_by_email(db: AsyncSession, email: str):
+    """Resolve an email through the global directory, then load the user from its shard"""
+    result = await db.execute(select(UserDirectory.id).filter(UserDirectory.email == email))
+    user_id = result.scalar()
+    if user_id is None:
+        return None
+    return await load_user(user_id)
+
+async def create_account(db: AsyncSession, email: str, password: str, is_admin: bool = False):
+    """Create a user on its shard; returns None if the email is already registered.
+
+    The directory row on the primary database allocates the user id and
+    enforces email uniqueness across all shards. While a shard plan is
+    pending, workers may run with the old or the new shard list, so the new
+    user is created on its shard under the old list, which both can reach,
+    and pinned there.
+    """
+    entry = UserDirectory(email=email)
+    db.add(entry)
+    try:
+        await db.flush()
+        result = await db.execute(select(ShardPlan.previous_shard_count).limit(1))
+        plan = result.first()
+        shard = None
+        if plan is not None:
+            shard = shards.ring_for(plan.previous_shard_count or len(shards.names)).node_for(entry.id)
+            db.add(ShardPin(user_id=entry.id, shard=shard))
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        return None
+    if shard is not None:
+        shards.pins[entry.id] = shard
+    
+    new_user = User(
+        id=entry.id,
+        email=email,
+        hashed_password=get_password_hash(password),
+        is_admin=is_admin
+    )
+    try:
+        async with shards.session_for(entry.id) as session:
+            session.add(new_user)
+            await session.commit()
+            await session.refresh(new_user)
+    except Exception:
+        # Release the email so registration can be retried
+        shards.pins.pop(entry.id, None)
+        await db.execute(delete(ShardPin).where(ShardPin.user_id == entry.id))
+        await db.delete(entry)
+        await db.commit()
+        raise
+    
+    return new_user
 
 @router.post('/login', response_model=Token)
 async def login(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     """Authenticate user and return JWT token"""
     try:
         # Find user by email
-        result = await db.execute(select(User).filter(User.email == user_data.email))
-        user = result.scalars().first()
+        user = await find_user_by_email(db, user_data.email)
         
         if not user or not verify_password(user_data.password, user.hashed_password):
             raise HTTPException(
@@ -27,17 +155,11 @@ async def login(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
                 headers={"WWW-Authenticate": "Bearer"},
             )
         
-        # Create access token
-        access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user.email, "user_id": user.id},
-            expires_delta=access_token_expires
-        )
+        # Create access and refresh tokens
+        tokens = issue_tokens(db, user)
+        await db.commit()
         
-        return {
-            "access_token": access_token,
-            "token_type": "bearer"
-        }
+        return tokens
     except HTTPException:
         raise
     except Exception as e:
@@ -50,49 +172,147 @@ async def login(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
 async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     """Register new user and return JWT token"""
     try:
-        # Check if user already exists
-        result = await db.execute(select(User).filter(User.email == user_data.email))
-        if result.scalars().first():
+        # Create new user unless the email is already registered
+        new_user = await create_account(db, user_data.email, user_data.password)
+        if new_user is None:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Email already registered"
             )
         
-        # Create new user
-        hashed_password = get_password_hash(user_data.password)
-        new_user = User(
-            email=user_data.email,
-            hashed_password=hashed_password,
-            is_admin=False
+        # Create access and refresh tokens for new user
+        tokens = issue_tokens(db, new_user)
+        await db.commit()
+        
+        return tokens
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Registration failed"
         )
+
+@router.post('/refresh', response_model=Token)
+async def refresh(token_in: RefreshRequest, db: AsyncSession = Depends(get_db)):
+    """Exchange a refresh token for a new access token and a rotated refresh token"""
+    invalid_token = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    
+    try:
+        result = await db.execute(
+            select(RefreshToken).filter(
+                RefreshToken.token_hash == hash_refresh_token(token_in.refresh_token)
+            )
+        )
+        stored = result.scalars().first()
+        if not stored:
+            raise invalid_token
         
-        db.add(new_user)
-        await db.commit()
-        await db.refresh(new_user)
+        now = datetime.now(timezone.utc)
+        expires_at = stored.expires_at
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        if expires_at <= now:
+            raise invalid_token
         
-        # Create access token for new user
-        access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": new_user.email, "user_id": new_user.id},
-            expires_delta=access_token_expires
+        # Mark the presented token as used. The conditional update makes two
+        # concurrent refreshes with the same token race for a single winner.
+        rotated = await db.execute(
+            update(RefreshToken)
+            .where(RefreshToken.id == stored.id, RefreshToken.revoked_at.is_(None))
+            .values(revoked_at=now)
         )
+        if rotated.rowcount != 1:
+            # An already-rotated token was presented again: either the client
+            # or an attacker holds a stolen copy, so kill the whole chain
+            await revoke_token_family(db, stored.family_id)
+            await db.commit()
+            raise invalid_token
         
-        return {
-            "access_token": access_token,
-            "token_type": "bearer"
-        }
+        user = await load_user(stored.user_id)
+        if not user:
+            await db.commit()
+            raise invalid_token
+        
+        tokens = issue_tokens(db, user, family_id=stored.family_id)
+        await db.commit()
+        
+        return tokens
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Registration failed"
+            detail="Token refresh failed"
         )
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
-    """Get current authenticated user from JWT token"""
-    from jose import JWTError, jwt
+@router.post('/logout')
+async def logout(token_in: RefreshRequest, db: AsyncSession = Depends(get_db)):
+    """Revoke a refresh token and every token rotated from it"""
+    try:
+        result = await db.execute(
+            select(RefreshToken).filter(
+                RefreshToken.token_hash == hash_refresh_token(token_in.refresh_token)
+            )
+        )
+        stored = result.scalars().first()
+        if stored:
+            await revoke_token_family(db, stored.family_id)
+            await db.commit()
+        
+        return {"success": True}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Logout failed"
+        )
+
+async def get_token_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> TokenData:
+    """Authorize from access token claims alone, without loading the user row"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    
+    try:
+        payload = decode_access_token(credentials.credentials)
+    except JWTError:
+        raise credentials_exception
     
+    user_id = payload.get("user_id")
+    if user_id is None:
+        raise credentials_exception
+    set_user_id(user_id)
+    
+    return TokenData(
+        id=user_id,
+        email=payload.get("sub"),
+        is_admin=payload.get("is_admin", False)
+    )
+
+async def get_optional_token_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+) -> Optional[TokenData]:
+    """Token user when a valid access token is sent, else None (anonymous)"""
+    if credentials is None:
+        return None
+    try:
+        return await get_token_user(credentials)
+    except HTTPException:
+        return None
+
+async def get_user_db(current_user: TokenData = Depends(get_token_user)):
+    """Session on the shard that holds the current user's rows"""
+    async with shards.session_for(current_user.id) as session:
+        yield session
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get current authenticated user from JWT token"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -100,20 +320,18 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     )
     
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, settings.JWT_SECRET, algorithms=["HS256"])
-        email: str = payload.get("sub")
+        payload = decode_access_token(credentials.credentials)
         user_id: int = payload.get("user_id")
         
-        if email is None or user_id is None:
+        if user_id is None:
             raise credentials_exception
             
     except JWTError:
         raise credentials_exception
+    set_user_id(user_id)
     
-    # Get user from database
-    result = await db.execute(select(User).filter(User.email == email))
-    user = result.scalars().first()
+    # Get user from its shard
+    user = await load_user(user_id)
     
     if user is None:
         raise credentials_exception
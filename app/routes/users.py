@@ -1,11 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
 from app.schemas import UserCreate, UserOut
 from app.database import get_db
 from app.models import User
-from app.auth import get_password_hash
-from app.routes.auth import get_current_user
+from app.routes.auth import get_current_user, create_account
 
 router = APIRouter(prefix='/users')
 
@@ -23,26 +21,14 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
 async def create_user(user_in: UserCreate, db: AsyncSession = Depends(get_db)):
     """Create new user account (public endpoint)"""
     try:
-        # Check if user already exists
-        result = await db.execute(select(User).filter(User.email == user_in.email))
-        if result.scalars().first():
+        # Create new user unless the email is already registered
+        new_user = await create_account(db, user_in.email, user_in.password)
+        if new_user is None:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail='User with this email already exists'
             )
         
-        # Create new user
-        hashed_password = get_password_hash(user_in.password)
-        new_user = User(
-            email=user_in.email,
-            hashed_password=hashed_password,
-            is_admin=False
-        )
-        
-        db.add(new_user)
-        await db.commit()
-        await db.refresh(new_user)
-        
         return UserOut(
             id=new_user.id,
             email=new_user.email,
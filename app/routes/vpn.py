@@ -1,14 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, status
+from sqlalchemy import func
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from app.database import get_db
-from app.models import User, VPNConfig
-from app.routes.auth import get_current_user
+from app.database import get_db, shards
+from app.config import settings
+from app.geoip import resolve_request_country
+from app.idempotency import run_idempotent
+from app.recommend import ServerCatalog, COUNTRY_CENTROIDS
+from app.models import VPNConfig
+from app.routes.auth import get_token_user, get_user_db
+from app.schemas import TokenData
 from app.utils import random_token
 import subprocess
 import ipaddress
 import os
-from typing import List, Dict
+from collections import Counter
+from typing import List, Dict, Optional
 
 router = APIRouter(prefix='/vpn')
 
@@ -66,6 +73,19 @@ MOCK_SERVERS = [
     }
 ]
 
+# Client address pool per server
+SERVER_NETWORKS = {
+    "us-east-1": "10.1.0.0/24",
+    "eu-west-1": "10.2.0.0/24",
+    "asia-south-1": "10.3.0.0/24",
+    "eu-north-1": "10.4.0.0/24",
+    "us-west-1": "10.5.0.0/24"
+}
+DEFAULT_SERVER_NETWORK = "10.9.0.0/24"
+
+# Precomputed arrays of the server list for /vpn/recommend
+server_catalog = ServerCatalog(MOCK_SERVERS, SERVER_NETWORKS, DEFAULT_SERVER_NETWORK)
+
 def generate_wireguard_keys():
     """Generate WireGuard private and public key pair"""
     try:
@@ -95,15 +115,7 @@ def allocate_client_ip(server_id: str, user_id: int) -> str:
     """Allocate IP address for client based on server and user"""
     # Simple IP allocation based on user ID and server
     # In production, maintain a proper IP pool per server
-    base_networks = {
-        "us-east-1": "10.1.0.0/24",
-        "eu-west-1": "10.2.0.0/24", 
-        "asia-south-1": "10.3.0.0/24",
-        "eu-north-1": "10.4.0.0/24",
-        "us-west-1": "10.5.0.0/24"
-    }
-    
-    network = base_networks.get(server_id, "10.9.0.0/24")
+    network = SERVER_NETWORKS.get(server_id, DEFAULT_SERVER_NETWORK)
     network_obj = ipaddress.IPv4Network(network)
     
     # Calculate client IP based on user ID (avoid network and broadcast)
@@ -112,8 +124,12 @@ def allocate_client_ip(server_id: str, user_id: int) -> str:
     
     return f"{client_ip}/32"
 
+def servers_cache_control(request: Request) -> str:
+    # The list is the same for every user, but it sits behind authentication
+    return f"private, max-age={settings.CATALOG_CACHE_TTL}"
+
 @router.get('/servers')
-async def list_servers(current_user: User = Depends(get_current_user)):
+async def list_servers(current_user: TokenData = Depends(get_token_user)):
     """List available VPN servers"""
     try:
         # Filter out servers in maintenance
@@ -133,13 +149,65 @@ async def list_servers(current_user: User = Depends(get_current_user)):
             detail="Failed to fetch servers"
         )
 
+async def refresh_assigned_counts():
+    """Reload per-server assigned address counts from every shard into the catalog"""
+    async def count_assigned(session):
+        result = await session.execute(
+            select(VPNConfig.server_id, func.count(VPNConfig.id)).group_by(VPNConfig.server_id)
+        )
+        return result.all()
+    
+    assigned = Counter()
+    for rows in await shards.fan_out(count_assigned):
+        for server_id, count in rows:
+            assigned[server_id] += count
+    server_catalog.update_assigned(assigned)
+
+@router.get('/recommend')
+async def recommend_servers(
+    request: Request,
+    limit: int = Query(3, ge=1, le=20, description="Number of servers to return"),
+    country: Optional[str] = Query(None, description="Client country (defaults to the client's location)"),
+    current_user: TokenData = Depends(get_token_user)
+):
+    """Rank online servers for the caller by distance, RTT, load and IP-pool headroom"""
+    try:
+        country = (country or resolve_request_country(request) or "").upper()
+        origin = COUNTRY_CENTROIDS.get(country)
+        
+        servers = server_catalog.top(limit, origin)
+        
+        return {
+            "servers": servers,
+            "country": country or None,
+            "total": len(servers)
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to recommend servers"
+        )
+
 @router.post('/assign')
 async def assign_vpn(
     assignment_data: dict,
-    current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: TokenData = Depends(get_token_user),
+    db: AsyncSession = Depends(get_db),
+    user_db: AsyncSession = Depends(get_user_db)
 ):
     """Assign VPN configuration to user for specific server"""
+    # Idempotency records are global; the configuration lives on the user's shard
+    return await run_idempotent(
+        db,
+        f"vpn.assign:{current_user.id}",
+        idempotency_key,
+        assignment_data,
+        lambda: create_vpn_assignment(assignment_data, current_user, user_db)
+    )
+
+async def create_vpn_assignment(assignment_data: dict, current_user: TokenData, db: AsyncSession):
+    """Return the user's configuration for the requested server, creating it if needed"""
     try:
         server_id = assignment_data.get('serverId')
         if not server_id:
@@ -231,8 +299,8 @@ async def assign_vpn(
 
 @router.get('/configs')
 async def get_user_configs(
-    current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    current_user: TokenData = Depends(get_token_user),
+    db: AsyncSession = Depends(get_user_db)
 ):
     """Get all VPN configurations for current user"""
     try:
@@ -267,8 +335,8 @@ async def get_user_configs(
 @router.delete('/configs/{config_id}')
 async def delete_config(
     config_id: int,
-    current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    current_user: TokenData = Depends(get_token_user),
+    db: AsyncSession = Depends(get_user_db)
 ):
     """Delete a VPN configuration"""
     try:
@@ -30,6 +30,14 @@ class VPNConfigOut(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
-    username: Optional[str] = None
\ No newline at end of file
+    """Claims carried by an access token, enough to authorize without a DB read"""
+    id: int
+    email: Optional[str] = None
+    is_admin: bool = False
\ No newline at end of file
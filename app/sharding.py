@@ -0,0 +1,120 @@
+"""User-sharded database routing.
+
+Rows owned by a user (``users``, ``vpn_configs``, ``ad_events``) live on one
+of N shard databases chosen by a consistent-hash ring over the user id.
+Global tables (the email directory, refresh tokens, idempotency keys and
+shard pins) stay on the primary database, ``DATABASE_URL``. With
+SHARD_DATABASE_URLS unset the primary is the only shard.
+
+Shards are named by position (``shard0``, ``shard1``, ...), so new shards must
+be appended to SHARD_DATABASE_URLS. Users that are being moved between shards
+are pinned in ``shard_pins``; a pin overrides the ring until the move has
+finished (see ``python -m app.rebalance``).
+"""
+import asyncio
+import hashlib
+import time
+from datetime import timedelta
+from bisect import bisect
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+
+from app.models import ShardPin, ShardPlan
+
+T = TypeVar("T")
+
+# Re-read pins updated this long before the newest one seen, in case they committed late
+PIN_REFRESH_OVERLAP = timedelta(seconds=60)
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+def parse_shard_urls(value: str, primary_url: str) -> List[str]:
+    """Shard URLs from a comma-separated setting; the primary alone when empty"""
+    urls = [url.strip() for url in value.split(",") if url.strip()]
+    return urls or [primary_url]
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes"""
+
+    def __init__(self, nodes: List[str], vnodes: int = 128):
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key) -> str:
+        idx = bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._nodes[idx]
+
+class ShardRouter:
+    def __init__(self, urls: List[str], primary: AsyncEngine, primary_url: str, vnodes: int = 128):
+        urls = urls or [primary_url]
+        self.names = [f"shard{i}" for i in range(len(urls))]
+        self.engines: Dict[str, AsyncEngine] = {
+            # Reuse the primary's pool when it doubles as a shard
+            name: primary if url == primary_url else create_async_engine(url)
+            for name, url in zip(self.names, urls)
+        }
+        self.sessionmakers = {
+            name: sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+            for name, engine in self.engines.items()
+        }
+        self.vnodes = vnodes
+        self.ring = HashRing(self.names, vnodes)
+        self._rings = {len(self.names): self.ring}
+        self.pins: Dict[int, str] = {}
+        self.pins_state = None  # (plan id, pins_version) the pins were loaded under
+        self.pins_seen_at = None  # newest updated_at loaded
+        self.pins_loaded_at = 0.0
+
+    def shard_for(self, user_id: Optional[int]) -> str:
+        """Shard holding the user's rows; rows without a user go to shard0"""
+        if user_id is None:
+            return self.names[0]
+        return self.pins.get(user_id) or self.ring.node_for(user_id)
+
+    def ring_for(self, shard_count: int) -> HashRing:
+        """Ring over the first shard_count shards, as a worker with a shorter shard list sees it"""
+        shard_count = min(shard_count, len(self.names))
+        if shard_count not in self._rings:
+            self._rings[shard_count] = HashRing(self.names[:shard_count], self.vnodes)
+        return self._rings[shard_count]
+
+    def session_for(self, user_id: Optional[int]) -> AsyncSession:
+        return self.sessionmakers[self.shard_for(user_id)]()
+
+    async def fan_out(self, query: Callable[[AsyncSession], Awaitable[T]], names: List[str] = None) -> List[T]:
+        """Run query concurrently on every shard (or the named ones) and collect the results"""
+        async def run(name):
+            async with self.sessionmakers[name]() as session:
+                return await query(session)
+
+        return await asyncio.gather(*(run(name) for name in names or self.names))
+
+    async def refresh_pins(self, session: AsyncSession):
+        """Load the user -> shard overrides from the primary database.
+
+        Only pins created or changed since the last load are read, unless the
+        plan or its pins_version changed (pins were deleted): then all are.
+        """
+        result = await session.execute(select(ShardPlan.id, ShardPlan.pins_version).limit(1))
+        state = tuple(result.first() or ()) or None
+        query = select(ShardPin.user_id, ShardPin.shard, ShardPin.updated_at)
+        if state == self.pins_state and self.pins_seen_at is not None:
+            query = query.where(ShardPin.updated_at >= self.pins_seen_at - PIN_REFRESH_OVERLAP)
+            pins = dict(self.pins)
+        else:
+            pins = {}
+        for user_id, shard, updated_at in (await session.execute(query)).all():
+            if shard in self.engines:
+                pins[user_id] = shard
+            if updated_at is not None and (self.pins_seen_at is None or updated_at > self.pins_seen_at):
+                self.pins_seen_at = updated_at
+        self.pins = pins
+        self.pins_state = state
+        self.pins_loaded_at = time.monotonic()
@@ -1,8 +1,18 @@
 import secrets
 import os
+from app.config import settings
 
 def random_token(n=32):
     return secrets.token_hex(n)
 
 def ensure_dir(path):
-    os.makedirs(path, exist_ok=True)
\ No newline at end of file
+    os.makedirs(path, exist_ok=True)
+
+def client_ip(request):
+    """Best-effort client address, honouring X-Forwarded-For behind trusted proxies"""
+    if settings.TRUST_PROXY_HEADERS and settings.TRUSTED_PROXY_COUNT > 0:
+        hops = [hop.strip() for hop in request.headers.get('x-forwarded-for', '').split(',') if hop.strip()]
+        # Each trusted proxy appends the address it saw; anything further left is client-supplied
+        if hops:
+            return hops[-min(settings.TRUSTED_PROXY_COUNT, len(hops))]
+    return request.client.host if request.client else None
@@ -0,0 +1,21 @@
+import os
+import tempfile
+
+# Settings and the shard engines are built at import time, so the
+# stand-in databases must be configured before anything imports app
+# (test_sharding adds shard2.db next to them)
+_db_dir = tempfile.mkdtemp(prefix="modernvpn-tests-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db_dir}/primary.db"
+os.environ["SHARD_DATABASE_URLS"] = f"{os.environ['DATABASE_URL']},sqlite+aiosqlite:///{_db_dir}/shard1.db"
+os.environ["JWT_SECRET"] = "test-secret"
+os.environ["FRAUD_VELOCITY_MAX_EVENTS"] = "100000"
+
+import pytest
+from fastapi.testclient import TestClient
+
+@pytest.fixture(scope="session")
+def client():
+    from app.main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
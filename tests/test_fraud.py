@@ -0,0 +1,100 @@
+from collections import Counter
+from types import SimpleNamespace
+
+from app import fraud
+from app.fraud import BloomFilter, CountMinSketch, EventFilter, RotatingBloomFilter, VelocityLimiter, event_source
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def test_bloom_filter_has_no_false_negatives_and_bounded_false_positives():
+    bloom = BloomFilter(capacity=5000, fp_rate=0.01)
+    keys = [f"member-{i}" for i in range(5000)]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    false_positives = sum(f"other-{i}" in bloom for i in range(20000))
+    assert false_positives / 20000 < 0.02
+
+def test_rotating_bloom_filter_forgets_keys_after_the_window(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fraud, "time", SimpleNamespace(monotonic=clock))
+    seen = RotatingBloomFilter(capacity=1000, fp_rate=0.01, window_seconds=60)
+
+    assert not seen.check_and_add("a")
+    assert seen.check_and_add("a")
+
+    # Half a window later the key lives on in the previous generation
+    clock.now += 30
+    assert not seen.check_and_add("b")
+    assert seen.rotations == 1
+    assert seen.check_and_add("a")
+
+    # "a" was re-added to the current generation by the lookup above
+    clock.now += 30
+    assert seen.check_and_add("a")
+    clock.now += 60
+    assert not seen.check_and_add("a")
+    assert not seen.check_and_add("b")
+
+def test_rotating_bloom_filter_rotates_early_at_capacity(monkeypatch):
+    monkeypatch.setattr(fraud, "time", SimpleNamespace(monotonic=Clock()))
+    seen = RotatingBloomFilter(capacity=10, fp_rate=0.01, window_seconds=60)
+    for i in range(10):
+        seen.check_and_add(f"key-{i}")
+    assert seen.rotations == 0
+
+    assert not seen.check_and_add("key-10")
+    assert seen.rotations == 1
+    assert seen.stats()["current_keys"] == 1
+    assert all(seen.check_and_add(f"key-{i}") for i in range(5))
+
+def test_count_min_sketch_never_underestimates():
+    sketch = CountMinSketch(width=256, depth=4)
+    counts = Counter({f"source-{i}": i % 7 + 1 for i in range(500)})
+    estimates = {}
+    for key, count in counts.items():
+        for _ in range(count):
+            estimates[key] = sketch.add(key)
+
+    assert all(estimates[key] >= count for key, count in counts.items())
+    sketch.clear()
+    assert sketch.add("source-1") == 1
+
+def test_velocity_limiter_resets_each_window(monkeypatch):
+    clock = Clock(now=600.0)
+    monkeypatch.setattr(fraud, "time", SimpleNamespace(time=clock))
+    limiter = VelocityLimiter(max_events=3, window_seconds=60)
+
+    assert [limiter.exceeded("user:1") for _ in range(4)] == [False, False, False, True]
+    assert not limiter.exceeded("user:2")
+
+    clock.now += 60
+    assert not limiter.exceeded("user:1")
+
+def test_event_filter_drops_duplicates_and_fast_sources():
+    events = EventFilter()
+    source = event_source(1, "203.0.113.7")
+
+    assert events.check(source, 10, "click") is None
+    assert events.check(source, 10, "click") == "duplicate"
+    assert events.check(source, 11, "click") is None
+    assert events.check(source, 10, "impression") is None
+    assert events.check(event_source(2, None), 10, "click") is None
+
+    # Events without an ad id are never duplicates of each other
+    assert events.check(source, None, "conversion") is None
+    assert events.check(source, None, "conversion") is None
+
+    events.velocity = VelocityLimiter(max_events=1, window_seconds=60)
+    assert events.check("ip:198.51.100.1", 12, "click") is None
+    assert events.check("ip:198.51.100.1", 13, "click") == "velocity"
+
+    assert events.accepted == 7
+    assert events.rejected == Counter({"duplicate": 1, "velocity": 1})
+    assert event_source(None, None) == "ip:unknown"
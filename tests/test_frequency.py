@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from app import frequency, rebalance
+from app.database import shards
+from app.frequency import FrequencyCapper, ImpressionSync
+from app.models import AdEvent
+
+MOVED_USER_ID = 910001
+AD_ID = 7
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def new_sync():
+    return ImpressionSync(FrequencyCapper(cap=10, window_seconds=3600, buckets=60, max_users=100))
+
+def test_capper_counts_impressions_over_a_sliding_window(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(frequency, "time", SimpleNamespace(time=clock))
+    capper = FrequencyCapper(cap=3, window_seconds=60, buckets=6, max_users=100)
+
+    capper.record(1, AD_ID)
+    clock.now += 30
+    capper.record(1, AD_ID)
+    capper.record(1, AD_ID + 1)
+    assert capper.count(1, AD_ID) == 2
+    assert capper.capped_ads(1) == frozenset()
+
+    capper.record(1, AD_ID)
+    assert capper.capped_ads(1) == {AD_ID}
+
+    # The first impression's bucket leaves the window; the ring slot is reused
+    clock.now += 30
+    assert capper.count(1, AD_ID) == 2
+    assert capper.capped_ads(1) == frozenset()
+    capper.record(1, AD_ID)
+    assert capper.count(1, AD_ID) == 3
+
+    clock.now += 60
+    assert capper.count(1, AD_ID) == 0
+    assert capper.count(1, AD_ID + 1) == 0
+    assert capper.count(2, AD_ID) == 0
+
+def test_capper_ignores_impressions_older_than_the_window(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(frequency, "time", SimpleNamespace(time=clock))
+    capper = FrequencyCapper(cap=3, window_seconds=60, buckets=6, max_users=100)
+
+    capper.record(1, AD_ID, at=clock.now - 60)
+    assert capper.count(1, AD_ID) == 0
+    capper.record(1, AD_ID, at=clock.now - 45)
+    capper.record(1, AD_ID)
+    assert capper.count(1, AD_ID) == 2
+    clock.now += 20
+    assert capper.count(1, AD_ID) == 1
+
+def test_capper_evicts_idle_and_least_recent_users(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(frequency, "time", SimpleNamespace(time=clock))
+    capper = FrequencyCapper(cap=3, window_seconds=60, buckets=6, max_users=2)
+
+    capper.record(1, AD_ID)
+    capper.record(2, AD_ID)
+    capper.record(1, AD_ID)
+    capper.record(3, AD_ID)
+    assert capper.stats()["users"] == 2
+    assert capper.count(2, AD_ID) == 0
+    assert capper.count(1, AD_ID) == 2
+
+    clock.now += 61
+    capper.evict()
+    assert capper.stats()["users"] == 0
+
+async def add_impressions(shard, user_id, count, age_seconds):
+    created_at = datetime.now(timezone.utc) - timedelta(seconds=age_seconds)
+    async with shards.sessionmakers[shard]() as session:
+        session.add_all([
+            AdEvent(user_id=user_id, event_type="impression", event_metadata={"adId": AD_ID}, created_at=created_at)
+            for _ in range(count)
+        ])
+        await session.commit()
+
+async def poll_all(sync):
+    for name in shards.names:
+        async with shards.sessionmakers[name]() as session:
+            await sync.poll(name, session)
+
+async def move_events(src_shard, dst_shard, user_id):
+    async with shards.sessionmakers[src_shard]() as src, shards.sessionmakers[dst_shard]() as dst:
+        await rebalance.copy_user_rows(src, dst, AdEvent, user_id)
+        await dst.commit()
+
+def test_first_poll_counts_the_window_and_skips_older_events(client):
+    client.portal.call(add_impressions, "shard0", MOVED_USER_ID + 1, 2, 7200)
+    client.portal.call(add_impressions, "shard0", MOVED_USER_ID + 1, 3, 60)
+
+    sync = new_sync()
+    client.portal.call(poll_all, sync)
+    assert sync.capper.count(MOVED_USER_ID + 1, AD_ID) == 3
+
+def test_events_copied_by_a_move_are_not_counted_twice(client):
+    client.portal.call(add_impressions, "shard0", MOVED_USER_ID, 4, 600)
+
+    sync = new_sync()
+    client.portal.call(poll_all, sync)
+    assert sync.capper.count(MOVED_USER_ID, AD_ID) == 4
+
+    # The move copies the events to shard1 with new ids and their original created_at
+    client.portal.call(move_events, "shard0", "shard1", MOVED_USER_ID)
+    client.portal.call(add_impressions, "shard1", MOVED_USER_ID, 1, 0)
+    client.portal.call(poll_all, sync)
+    assert sync.capper.count(MOVED_USER_ID, AD_ID) == 5
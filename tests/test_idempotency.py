@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.future import select
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.idempotency import request_fingerprint, run_idempotent
+from app.models import IdempotencyKey
+
+PAYLOAD = {"serverId": "us-east-1"}
+
+async def pending_claim(key, age_seconds):
+    async with AsyncSessionLocal() as session:
+        now = datetime.now(timezone.utc)
+        session.add(IdempotencyKey(
+            key=f"test:{key}",
+            fingerprint=request_fingerprint(PAYLOAD),
+            claimed_at=now - timedelta(seconds=age_seconds),
+            expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS)
+        ))
+        await session.commit()
+
+async def retry(key):
+    async def handler():
+        return {"success": True}
+
+    async with AsyncSessionLocal() as session:
+        return await run_idempotent(session, "test", key, PAYLOAD, handler)
+
+async def stored_status(key):
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(IdempotencyKey.status_code).where(IdempotencyKey.key == f"test:{key}")
+        )
+        return result.scalar()
+
+def test_live_claim_blocks_a_retry(client):
+    client.portal.call(pending_claim, "live", 1)
+
+    with pytest.raises(HTTPException) as exc:
+        client.portal.call(retry, "live")
+    assert exc.value.status_code == 409
+    assert client.portal.call(stored_status, "live") is None
+
+def test_stale_claim_is_taken_over(client):
+    client.portal.call(pending_claim, "stale", settings.IDEMPOTENCY_LEASE_SECONDS + 5)
+
+    assert client.portal.call(retry, "stale") == {"success": True}
+    assert client.portal.call(stored_status, "stale") == 200
+    # Further retries replay the stored response
+    assert client.portal.call(retry, "stale").headers["Idempotent-Replayed"] == "true"
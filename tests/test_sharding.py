@@ -0,0 +1,317 @@
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, insert, update
+from sqlalchemy.future import select
+
+from app import rebalance
+from app.config import settings
+from app.database import AsyncSessionLocal, engine, shards
+from app.models import AdEvent, Base, SHARDED_TABLES, ShardPin, ShardPlan, User, UserDirectory, VPNConfig
+from app.routes import auth as auth_routes
+from app.routes.auth import create_account, load_user
+from app.sharding import HashRing, ShardRouter, parse_shard_urls
+
+PRIMARY_URL = settings.DATABASE_URL
+SHARD_URLS = parse_shard_urls(settings.SHARD_DATABASE_URLS, PRIMARY_URL)
+EXTRA_SHARD_URL = PRIMARY_URL.replace("primary.db", "shard2.db")
+
+def register(client, email, password="secret-pw"):
+    response = client.post("/auth/register", json={"email": email, "password": password})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def auth_headers(tokens):
+    return {"Authorization": f"Bearer {tokens['access_token']}"}
+
+async def user_shards(router, user_id):
+    """Names of the shards that hold a users row for user_id"""
+    found = []
+    for name in router.names:
+        async with router.sessionmakers[name]() as session:
+            result = await session.execute(select(User.id).where(User.id == user_id))
+            if result.first() is not None:
+                found.append(name)
+    return found
+
+async def create_extra_shard(router):
+    async with router.engines["shard2"].begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=SHARDED_TABLES)
+
+async def pins():
+    async with AsyncSessionLocal() as session:
+        return dict((await session.execute(select(ShardPin.user_id, ShardPin.shard))).all())
+
+async def directory_id(email):
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(UserDirectory.id).where(UserDirectory.email == email))
+        return result.scalar()
+
+def test_ring_routing_is_stable_and_honours_pins():
+    ring = HashRing(["shard0", "shard1", "shard2"], vnodes=128)
+    placement = {key: ring.node_for(key) for key in range(3000)}
+    assert placement == {key: ring.node_for(key) for key in range(3000)}
+    assert all(count > 600 for count in Counter(placement.values()).values())
+
+    # Adding a node only moves keys onto the new node
+    grown = HashRing(["shard0", "shard1", "shard2", "shard3"], vnodes=128)
+    moved = [key for key in placement if grown.node_for(key) != placement[key]]
+    assert all(grown.node_for(key) == "shard3" for key in moved)
+    assert 0.15 < len(moved) / len(placement) < 0.35
+
+    router = ShardRouter(SHARD_URLS, primary=engine, primary_url=PRIMARY_URL)
+    assert router.shard_for(None) == "shard0"
+    user_id = next(key for key in range(1, 100) if router.ring.node_for(key) == "shard1")
+    router.pins[user_id] = "shard0"
+    assert router.shard_for(user_id) == "shard0"
+
+def test_register_and_login_go_through_the_directory(client):
+    tokens = register(client, "alice@example.com")
+    user_id = client.portal.call(directory_id, "alice@example.com")
+
+    assert user_id is not None
+    assert client.portal.call(user_shards, shards, user_id) == [shards.ring.node_for(user_id)]
+
+    me = client.get("/users/me", headers=auth_headers(tokens))
+    assert me.status_code == 200
+    assert me.json()["email"] == "alice@example.com"
+
+    login = client.post("/auth/login", json={"email": "alice@example.com", "password": "secret-pw"})
+    assert login.status_code == 200
+    assert client.post("/auth/login", json={"email": "alice@example.com", "password": "wrong"}).status_code == 401
+    assert client.post("/auth/register", json={"email": "alice@example.com", "password": "x"}).status_code == 400
+
+def test_admin_stats_fans_out_across_shards(client):
+    placed = Counter()
+    for i in range(12):
+        tokens = register(client, f"stats-{i}@example.com")
+        response = client.post("/vpn/assign", json={"serverId": "us-east-1"}, headers=auth_headers(tokens))
+        assert response.status_code == 200, response.text
+        user_id = client.portal.call(directory_id, f"stats-{i}@example.com")
+        placed[shards.shard_for(user_id)] += 1
+    assert len(placed) == 2
+
+    client.portal.call(create_account_on_primary, "stats-admin@example.com")
+    admin = client.post("/auth/login", json={"email": "stats-admin@example.com", "password": "admin-pw"}).json()
+    stats = client.get("/admin/stats", headers=auth_headers(admin)).json()
+
+    async def count(name, model):
+        async with shards.sessionmakers[name]() as session:
+            return (await session.execute(select(func.count(model.id)))).scalar()
+
+    for name in shards.names:
+        assert stats["shards"][name]["users"] == client.portal.call(count, name, User)
+        assert stats["shards"][name]["vpn_configs"] == client.portal.call(count, name, VPNConfig)
+    assert stats["active_users"] == sum(s["users"] for s in stats["shards"].values())
+
+    async def server_configs():
+        return sum(await shards.fan_out(
+            lambda session: session.scalar(select(func.count(VPNConfig.id)).where(VPNConfig.server_id == "us-east-1"))
+        ))
+
+    configs = client.portal.call(server_configs)
+    assert configs >= 12
+    assert {"id": "us-east-1", "configs": configs} in stats["servers"]
+
+async def create_account_on_primary(email):
+    async with AsyncSessionLocal() as session:
+        assert await create_account(session, email, "admin-pw", is_admin=True) is not None
+
+def test_plan_and_move_to_an_added_shard(client, monkeypatch):
+    emails = [f"move-{i}@example.com" for i in range(20)]
+    for i, email in enumerate(emails):
+        tokens = register(client, email)
+        if i % 2 == 0:
+            response = client.post("/vpn/assign", json={"serverId": "us-east-1"}, headers=auth_headers(tokens))
+            assert response.status_code == 200, response.text
+
+    new_urls = SHARD_URLS + [EXTRA_SHARD_URL]
+    new_router = ShardRouter(new_urls, primary=engine, primary_url=PRIMARY_URL, vnodes=settings.SHARD_VNODES)
+
+    async def plans():
+        async with AsyncSessionLocal() as session:
+            return (await session.execute(select(func.count(ShardPlan.id)))).scalar()
+
+    client.portal.call(create_extra_shard, new_router)
+    client.portal.call(rebalance.plan, new_urls, 0)
+
+    planned = client.portal.call(pins)
+    assert planned
+    assert client.portal.call(plans) == 1
+    for user_id, shard in planned.items():
+        assert new_router.ring.node_for(user_id) != shard
+        assert client.portal.call(user_shards, shards, user_id) == [shard]
+
+    # A user registered while the plan is pending is pinned to its shard under the old list
+    register(client, "during-plan@example.com")
+    late_id = client.portal.call(directory_id, "during-plan@example.com")
+    assert client.portal.call(pins)[late_id] == shards.ring.node_for(late_id)
+
+    monkeypatch.setattr(rebalance, "shards", new_router)
+    client.portal.call(rebalance.move, 100, 0)
+
+    assert client.portal.call(pins) == {}
+    assert client.portal.call(plans) == 0
+    user_ids = [client.portal.call(directory_id, email) for email in emails + ["during-plan@example.com"]]
+    for user_id in user_ids:
+        assert client.portal.call(user_shards, new_router, user_id) == [new_router.ring.node_for(user_id)]
+
+    async def configs_by_shard():
+        placed = Counter()
+        for name in new_router.names:
+            async with new_router.sessionmakers[name]() as session:
+                result = await session.execute(select(VPNConfig.user_id).where(VPNConfig.user_id.in_(user_ids)))
+                placed.update((user_id, name) for user_id in result.scalars().all())
+        return placed
+
+    assigned = {client.portal.call(directory_id, email) for email in emails[::2]}
+    assert client.portal.call(configs_by_shard) == Counter(
+        {(user_id, new_router.ring.node_for(user_id)): 1 for user_id in assigned}
+    )
+
+def test_old_list_workers_reach_users_registered_by_new_list_workers(client, monkeypatch):
+    old_router = ShardRouter(SHARD_URLS, primary=engine, primary_url=PRIMARY_URL, vnodes=settings.SHARD_VNODES)
+    new_urls = SHARD_URLS + [EXTRA_SHARD_URL]
+    new_router = ShardRouter(new_urls, primary=engine, primary_url=PRIMARY_URL, vnodes=settings.SHARD_VNODES)
+    client.portal.call(create_extra_shard, new_router)
+
+    async def start_plan():
+        async with AsyncSessionLocal() as session:
+            session.add(ShardPlan(shard_urls=",".join(new_urls), previous_shard_count=len(SHARD_URLS)))
+            await session.commit()
+
+    async def end_plan(user_ids):
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(ShardPin).where(ShardPin.user_id.in_(user_ids)))
+            await session.execute(delete(ShardPlan))
+            await session.commit()
+
+    async def register_on_new_list(email):
+        async with AsyncSessionLocal() as session:
+            return (await create_account(session, email, "secret-pw")).id
+
+    async def refresh(router):
+        async with AsyncSessionLocal() as session:
+            await router.refresh_pins(session)
+
+    client.portal.call(start_plan)
+    monkeypatch.setattr(auth_routes, "shards", new_router)
+    user_ids = []
+    try:
+        # Register until the new ring would place a user on the added shard
+        for i in range(100):
+            user_ids.append(client.portal.call(register_on_new_list, f"new-list-{i}@example.com"))
+            if new_router.ring.node_for(user_ids[-1]) == "shard2":
+                break
+        user_id = user_ids[-1]
+        assert new_router.ring.node_for(user_id) == "shard2"
+
+        old_shard = old_router.ring.node_for(user_id)
+        assert client.portal.call(user_shards, new_router, user_id) == [old_shard]
+        assert new_router.shard_for(user_id) == old_shard
+
+        client.portal.call(refresh, old_router)
+        assert old_router.shard_for(user_id) == old_shard
+
+        # Another new-list worker finds the user before its next pin refresh
+        other_worker = ShardRouter(new_urls, primary=engine, primary_url=PRIMARY_URL, vnodes=settings.SHARD_VNODES)
+        monkeypatch.setattr(auth_routes, "shards", other_worker)
+        assert client.portal.call(load_user, user_id).email == f"new-list-{len(user_ids) - 1}@example.com"
+    finally:
+        client.portal.call(end_plan, user_ids)
+
+def test_finish_user_catches_up_out_of_order_rows_and_deletions(client):
+    user_id = 920001
+
+    async def seed():
+        async with shards.sessionmakers["shard0"]() as session:
+            session.add(User(id=user_id, email="finish@example.com", hashed_password="x"))
+            session.add_all([
+                VPNConfig(id=50001, user_id=user_id, server_id="us-east-1"),
+                VPNConfig(id=50003, user_id=user_id, server_id="us-west-1"),
+                AdEvent(id=50001, user_id=user_id, event_type="view"),
+                AdEvent(id=50003, user_id=user_id, event_type="view"),
+            ])
+            await session.commit()
+        async with AsyncSessionLocal() as primary:
+            primary.add(ShardPin(user_id=user_id, shard="shard0"))
+            await primary.commit()
+
+    async def copy_then_write_to_the_old_shard():
+        async with AsyncSessionLocal() as primary:
+            pin = await primary.get(ShardPin, user_id)
+            await rebalance.copy_user(pin, "shard1")
+            await primary.commit()
+        # Stale workers still write to shard0; ids can commit out of order
+        async with shards.sessionmakers["shard0"]() as session:
+            await session.execute(delete(VPNConfig).where(VPNConfig.id == 50001))
+            session.add(VPNConfig(id=50002, user_id=user_id, server_id="eu-west-1"))
+            session.add(AdEvent(id=50002, user_id=user_id, event_type="click"))
+            await session.commit()
+
+    async def finish():
+        async with AsyncSessionLocal() as primary:
+            pin = await primary.get(ShardPin, user_id)
+            await rebalance.finish_user(primary, pin)
+            await primary.delete(pin)
+            await primary.commit()
+
+    async def rows(name):
+        async with shards.sessionmakers[name]() as session:
+            servers = await session.execute(select(VPNConfig.server_id).where(VPNConfig.user_id == user_id))
+            events = await session.execute(select(AdEvent.event_type).where(AdEvent.user_id == user_id))
+            return sorted(servers.scalars().all()), sorted(events.scalars().all())
+
+    client.portal.call(seed)
+    client.portal.call(copy_then_write_to_the_old_shard)
+    client.portal.call(finish)
+
+    assert client.portal.call(rows, "shard0") == ([], [])
+    assert client.portal.call(rows, "shard1") == (["eu-west-1", "us-west-1"], ["click", "view", "view"])
+    assert client.portal.call(user_shards, shards, user_id) == ["shard1"]
+
+    async def cleanup():
+        async with shards.sessionmakers["shard1"]() as session:
+            await rebalance.delete_user_rows(session, user_id)
+            await session.commit()
+
+    client.portal.call(cleanup)
+
+def test_refresh_pins_is_incremental_until_pins_are_deleted(client):
+    router = ShardRouter(SHARD_URLS, primary=engine, primary_url=PRIMARY_URL, vnodes=settings.SHARD_VNODES)
+    old_pin, new_pin = 930001, 930002
+
+    async def refresh():
+        async with AsyncSessionLocal() as session:
+            await router.refresh_pins(session)
+
+    async def run(*statements):
+        async with AsyncSessionLocal() as session:
+            for statement in statements:
+                await session.execute(statement)
+            await session.commit()
+
+    hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+    client.portal.call(run, insert(ShardPlan).values(shard_urls=",".join(SHARD_URLS), pins_version=0))
+    client.portal.call(run, insert(ShardPin).values(user_id=old_pin, shard="shard1", updated_at=hour_ago))
+    try:
+        client.portal.call(refresh)
+        assert router.pins[old_pin] == "shard1"
+
+        # Only pins changed since the last load are read, so a bare delete goes unnoticed
+        client.portal.call(
+            run,
+            insert(ShardPin).values(user_id=new_pin, shard="shard0"),
+            delete(ShardPin).where(ShardPin.user_id == old_pin)
+        )
+        client.portal.call(refresh)
+        assert router.pins[new_pin] == "shard0"
+        assert old_pin in router.pins
+
+        # A version bump makes the next refresh reload every pin
+        client.portal.call(run, update(ShardPlan).values(pins_version=ShardPlan.pins_version + 1))
+        client.portal.call(refresh)
+        assert router.pins[new_pin] == "shard0"
+        assert old_pin not in router.pins
+    finally:
+        client.portal.call(run, delete(ShardPin).where(ShardPin.user_id.in_([old_pin, new_pin])), delete(ShardPlan))